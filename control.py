@@ -21,28 +21,45 @@ try:
 except ImportError:
     print('geoip will be unavailable. Try `pip3 install python-geoip-python3 python-geoip-geolite2`')
 
+try:
+    from multiprocessing import shared_memory # python 3.8+, only needed for --ingest_process
+except ImportError:
+    shared_memory = None # type: ignore
+
 import argparse
 import base64
+import bisect
 import collections
-import copy
+import heapq
+import ipaddress
 import itertools
+import json
+import logging
+import logging.handlers
 import math
+import mmap
+import multiprocessing
 import os
 import queue
 import re
 import select
+import signal
 import sys
 import socket
+import socketserver
+import sqlite3
 import struct
 import time
 import timeit
+from abc import ABC, abstractmethod
 from enum import IntEnum
 from random import random
 from statistics import mean
 import subprocess
-from threading import Thread
-from typing import (IO, Any, Callable, Dict, Iterable, List, Match, Optional,
-                    Pattern, Tuple, cast)
+from threading import Condition, Event, Lock, Thread
+from types import MappingProxyType
+from typing import (IO, Any, Callable, Dict, FrozenSet, Iterable, Iterator, List, Mapping, Match, NamedTuple,
+                    Optional, Pattern, Set, Tuple, cast)
 
 DIR_PATH = os.path.dirname(os.path.realpath(__file__))
 
@@ -60,7 +77,9 @@ SERVER_LOG_PATH = "serverlog.txt"
 # your specific lobby's parameters 
 #================================================================================#
 MIN_PLAYER_LEVEL = 5
-LOBBY_RULES = f"[EXPERIMENTAL, type 'commands' for more commands] server rules: strictly no teamkilling (even in self-defense); mark starting zones with flare or chat; minimum player level: {MIN_PLAYER_LEVEL}; no support decks (auto-enforced); offensive language may result in kick/ban"
+def format_lobby_rules(min_player_level: int) -> str:
+    return f"[EXPERIMENTAL, type 'commands' for more commands] server rules: strictly no teamkilling (even in self-defense); mark starting zones with flare or chat; minimum player level: {min_player_level}; no support decks (auto-enforced); offensive language may result in kick/ban"
+LOBBY_RULES = format_lobby_rules(MIN_PLAYER_LEVEL)
 MIN_VOTES_TO_KICK = 3
 MAX_BADWORDS_BEFORE_KICK = 3
 MIN_VOTES_TO_ROTATE = 3
@@ -68,6 +87,10 @@ MIN_VOTES_TO_YEAR = 3
 MIN_VOTES_TO_CHANGE_INCOME = 3
 DISCONNECTS_IN_LAST_N_MINUTES_TO_BAN = 1
 NUM_DISCONNECTS_IN_N_MINUTES_TO_BAN = 3
+KICKS_BEFORE_AUTOBAN = 3 # players kicked this many times within KICK_MEMORY_SECONDS are banned when they next connect
+KICK_MEMORY_SECONDS = 7 * 24 * 3600 # kicks (by vote or for language) older than this are forgotten
+AUTOBAN_SECONDS = 24 * 3600 # how long that ban lasts
+BADWORD_MEMORY_SECONDS = 24 * 3600 # badwords older than this no longer count towards a kick
 GENERAL_BLUE_DECK = "@Hs8KGG5CiPWIZrDQSmUgBUimgjmLJlTw6CeCLEkaM6Y0qHI3ypcoaIjS1JFAKCyxII5KPgkMI3IFSGEjzJ+iq0qzKSiXoA=="
 GENERAL_RED_DECK = "@Us8JknYKpymQ0KaIKC4i1CeRZKDIvjGshwUAcYm9aWwckJ+IrSdog7IBCBUkvJGSRwoUIOiNgiPRSidknuJQCBMohSXg"
 MAP_POOL = [
@@ -101,6 +124,194 @@ UNSPEC_DECK_TYPES = [207]
 ARMORED_DECK_TYPES = [179, 3]
 MOTORIZED_DECK_TYPES = [81]
 NON_EXISTENT_CLIENT_ID = 0x0c6c0b
+MAX_CHAT_LINE_LENGTH = 200 # longer messages are split on word boundaries
+CHAT_MESSAGES_PER_SECOND = 2.0 # outbound chat rate limit, per server
+CHAT_BURST = 5
+MAX_PENDING_CHAT_MESSAGES = 50 # the oldest pending messages are dropped beyond this
+JOURNAL_SEGMENT_BYTES = 64 * 1024 * 1024 # start a new journal file after this many bytes
+JOURNAL_FSYNC_INTERVAL = 1.0 # seconds between journal fsyncs
+JOURNAL_BATCH_SIZE = 512 # max records written per batch
+JOURNAL_QUEUE_SIZE = 100000 # records beyond this are dropped rather than block the caller
+REPUTATION_FLUSH_INTERVAL = 2.0 # seconds between reputation write-backs
+STATS_BROADCAST_INTERVAL = 100 # seconds between checks for changed team averages, the cadence of the old console loop
+COMMANDS_REMINDER_INTERVAL = 100 * 60 # seconds between "chat 'commands'" reminders
+VOTE_EXPIRY_SECONDS = 5 * 60 # votes older than this no longer count
+PLAYER_COMMANDS_PER_SECOND = 0.5 # chat commands each player may send, beyond the burst
+PLAYER_COMMAND_BURST = 3
+VOTE_COMMANDS_PER_SECOND = 1.0 # shared by all players, per vote command
+VOTE_COMMAND_BURST = 5
+BALANCE_COMMAND_INTERVAL = 10 # seconds, shared by all players
+WHEREFROM_COMMAND_INTERVAL = 30 # seconds, shared by all players
+INGEST_RING_BYTES = 4 * 1024 * 1024 # shared memory between the ingest process and the controller
+LAG_BYTES_THRESHOLD = 256 * 1024 # unread server log beyond this puts a game in degraded mode
+LAG_SECONDS_THRESHOLD = 2.0 # as does taking longer than this to handle what was read
+RESPONSE_REPEAT_SECONDS = 30 # an identical command answer isn't sent again within this
+POLICY_CHECK_INTERVAL = 5 # seconds between checks of the policy file for changes
+RCON_TIMEOUT = 2.0 # seconds for a whole rcon command, connecting included
+RCON_FAILURES_TO_OPEN = 3 # consecutive failures before rcon commands fail fast
+RCON_BACKOFF_BASE = 1.0 # seconds before the first retry once failing fast, doubling up to RCON_BACKOFF_MAX
+RCON_BACKOFF_MAX = 60.0
+RCON_OUTAGE_BUFFER = 100 # commands kept for when the server is back, the oldest are dropped beyond this
+RCON_DROPPABLE_COMMANDS = ('chat',) # not worth sending late, so dropped during an outage
+RCON_RETRY_POLL = 1.0 # seconds between checks for held commands that can be retried
+LOG_QUEUE_SIZE = 10000 # log records beyond this are dropped rather than block the caller
+LOG_REPEAT_INTERVAL = 10.0 # seconds
+LOG_REPEAT_BURST = 5 # identical log messages let through per interval
+STATE_WAIT_TIMEOUT = 60 # seconds a state socket "wait" blocks before returning the current snapshot
+LOG_READ_BYTES = 1024 * 1024 # server and chat logs are read in blocks of this size
+# player events that must refer to a player connected earlier in the log
+PLAYER_EVENTS = ('deck', 'level', 'elo', 'side', 'name', 'disconnect')
+# server variables that persist across lobbies, so may have been set before the last one
+SETTING_EVENTS = ('min_players', 'map')
+CHAT_LINE_REGEX = re.compile(r'\[\d+\] (\d+): (.+)')
+# CHAT_LINE_REGEX for finding the lines of a block of chat log bytes
+CHAT_LINE_FILTER = re.compile(b'^' + CHAT_LINE_REGEX.pattern.encode(), re.M)
+# every serverlog.txt line we act on, by event name. Also used by logindex.py
+EVENT_PATTERNS: List[Tuple[str, str]] = [
+    ('connect', r'Client added in session \(EugNetId : ([0-9]+).+IP : ([0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}):([0-9]+)'),
+    ('deck', 'Client ([0-9]+) variable PlayerDeckContent set to "(.*)"'),
+    ('level', 'Client ([0-9]+) variable PlayerLevel set to "(.*)"'),
+    ('elo', 'Client ([0-9]+) variable PlayerElo set to "(.*)"'),
+    ('side', 'Client ([0-9]+) variable PlayerAlliance set to "([0-9])"'),
+    ('name', 'Client ([0-9]+) variable PlayerName set to "(.*)"'),
+    ('disconnect', 'Disconnecting client ([0-9]+)'),
+    ('game', 'Entering in loading phase state'),
+    ('deployment', 'Entering in deploiement phase state'),
+    ('debriefing', 'Entering in debriephing phase state'),
+    ('lobby', 'Entering in matchmaking state'),
+    ('min_players', 'Variable NbMinPlayer set to "(.*)"'),
+    ('map', 'Variable Map set to "(.*)"'),
+]
+
+def literal_prefix(regex: str) -> bytes:
+    """The fixed text every match of `regex` starts with, for cheap substring searches"""
+    prefix: List[str] = []
+    i = 0
+    while i < len(regex):
+        c = regex[i]
+        if c == '\\' and i + 1 < len(regex) and not regex[i + 1].isalnum():
+            prefix.append(regex[i + 1])
+            i += 2
+            continue
+        if c in '.^$*+?{}[]|()\\':
+            break
+        prefix.append(c)
+        i += 1
+    if i < len(regex) and regex[i] in '*?{' and prefix:
+        prefix.pop() # the last character is optional
+    return ''.join(prefix).encode()
+
+class LineFilter:
+    """
+    Finds the lines of a block of log bytes that start with the literal prefix
+    of one of `regexes`, along with the indexes of the regexes that may match
+    them. All other lines are skipped by the regex engine, without being
+    split out, copied or decoded.
+    """
+
+    def __init__(self, regexes: List[str]) -> None:
+        prefixes = [literal_prefix(regex) for regex in regexes]
+        # longest first, so that each line gets the most specific group
+        distinct = sorted(set(prefixes), key=len, reverse=True)
+        self.regex = re.compile(b'^(?:' + b'|'.join(b'(' + re.escape(prefix) + b')' for prefix in distinct) + b').*', re.M)
+        self.candidates: List[List[int]] = [[]] + [
+            [index for index, prefix in enumerate(prefixes) if group.startswith(prefix)] for group in distinct]
+
+    def lines(self, data: bytes, end: int) -> Iterator[Tuple[bytes, List[int]]]:
+        for match in self.regex.finditer(data, 0, end):
+            yield match.group(0), self.candidates[cast(int, match.lastindex)]
+
+
+def read_blocks(f: IO[bytes]) -> Iterator[Tuple[bytes, int]]:
+    """
+    Read `f` from its position in blocks of LOG_READ_BYTES, yielding each with
+    the length of its complete lines. A partial last line is carried over to
+    the next block; at the end of the file it is left unread.
+    """
+    pending = b''
+    while True:
+        block = f.read(LOG_READ_BYTES)
+        if not block:
+            return
+        data = pending + block if pending else block
+        end = data.rfind(b'\n') + 1
+        if end:
+            yield data, end
+        pending = data[end:]
+
+log = logging.getLogger('control')
+
+class RepeatFilter(logging.Filter):
+    """
+    Lets through at most LOG_REPEAT_BURST identical messages (same text and
+    arguments) per LOG_REPEAT_INTERVAL, and notes how many were suppressed on
+    the next one that gets through. Works on the unformatted record, so it is
+    cheap enough to run on the caller's thread.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.seen: Dict[Any, List[float]] = {} # key -> [window start, count in window, suppressed]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        try:
+            key = (record.levelno, record.msg, record.args)
+            hash(key)
+        except TypeError:
+            return True
+        now = record.created
+        entry = self.seen.get(key)
+        if entry is None or now - entry[0] > LOG_REPEAT_INTERVAL:
+            if len(self.seen) > 1000:
+                self.seen = {k: v for k, v in self.seen.items() if now - v[0] <= LOG_REPEAT_INTERVAL}
+            if entry is not None and entry[2]:
+                record.msg = str(record.msg) + f' [{int(entry[2])} repeats suppressed]'
+            self.seen[key] = [now, 1, 0]
+            return True
+        entry[1] += 1
+        if entry[1] > LOG_REPEAT_BURST:
+            entry[2] += 1
+            return False
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to the writer thread without ever blocking: when the queue
+    is full they are counted and dropped. Unlike the stock QueueHandler the
+    record isn't formatted here, that happens on the writer thread.
+    """
+
+    def __init__(self, log_queue: 'queue.Queue[logging.LogRecord]') -> None:
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            if self.dropped:
+                self.queue.put_nowait(logging.makeLogRecord({'name': log.name, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                                                             'msg': f'dropped {self.dropped} log messages'}))
+                self.dropped = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(level: str) -> None:
+    """Send log records through a bounded queue to a thread writing to stdout"""
+    log_queue: 'queue.Queue[logging.LogRecord]' = queue.Queue(LOG_QUEUE_SIZE)
+    handler = DroppingQueueHandler(log_queue)
+    handler.addFilter(RepeatFilter())
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    logging.handlers.QueueListener(log_queue, output).start()
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(level.upper())
+
 
 class Side(IntEnum):
     Bluefor = 0
@@ -112,26 +323,187 @@ class GameState(IntEnum):
     Debriefing = 3
     Deployment = 4
 
+class ServerConfig(NamedTuple):
+    """
+    Everything that differs between two wargame3-server instances driven by
+    the same control process
+    """
+    name: str = "default"
+    log_path: str = SERVER_LOG_PATH
+    chat_path: str = DEFAULT_CHAT_PATH
+    rcon_host: str = "localhost"
+    rcon_port: str = DEFAULT_RCON_PORT
+    rcon_password: str = DEFAULT_RCON_PASSWORD
+    min_player_level: int = MIN_PLAYER_LEVEL
+    map_pool: Tuple[str, ...] = tuple(MAP_POOL)
+    lobby_rules: Optional[str] = None # defaults to the standard rules for min_player_level
+    banned_clients_path: str = "banned_clients.ini"
+
+    def get_lobby_rules(self) -> str:
+        return self.lobby_rules or format_lobby_rules(self.min_player_level)
+
+def load_server_configs(path: str) -> List[ServerConfig]:
+    """
+    Read a json config listing the servers to control, eg:
+        { "servers": [ { "name": "eu1", "log_path": "/srv/eu1/serverlog.txt", "chat_path": "/srv/eu1/chat.txt",
+                         "rcon_port": "10842", "rcon_password": "...", "min_player_level": 5 }, ... ] }
+    Missing fields take the defaults from the top of this file.
+    """
+    with open(path) as fin:
+        raw = json.load(fin)
+    configs: List[ServerConfig] = []
+    for i, entry in enumerate(raw.get('servers', [])):
+        unknown = set(entry.keys()) - set(ServerConfig._fields)
+        if unknown:
+            raise ValueError(f'{path}: unknown fields for server #{i}: {", ".join(sorted(unknown))}')
+        entry.setdefault('name', f'server{i}')
+        if 'rcon_port' in entry:
+            entry['rcon_port'] = str(entry['rcon_port'])
+        if 'map_pool' in entry:
+            entry['map_pool'] = tuple(entry['map_pool'])
+        configs.append(ServerConfig(**entry))
+    if not configs:
+        raise ValueError(f'{path}: no servers configured')
+    names = [config.name for config in configs]
+    if len(set(names)) != len(names):
+        raise ValueError(f'{path}: server names must be unique')
+    return configs
+
+POLICY_CONFIG_FIELDS = ('min_player_level', 'map_pool', 'lobby_rules') # policy values that override ServerConfig
+POLICY_LIMIT_FIELDS = ('min_votes_to_kick', 'min_votes_to_rotate', 'min_votes_to_year', 'min_votes_to_change_income',
+                       'max_badwords_before_kick', 'num_disconnects_to_ban', 'kicks_before_autoban')
+
+def compile_badwords(words: Iterable[str]) -> Optional[Pattern[str]]:
+    """One regex for all badwords, so a chat line is scanned once instead of once per word"""
+    words = sorted({word.replace('*', '').strip().lower() for word in words} - {''}, key=len, reverse=True)
+    return re.compile('|'.join(re.escape(word) for word in words)) if words else None
+
+class Policy(NamedTuple):
+    """
+    Lobby rules that can be changed while the servers run, compiled from the
+    policy file into the structures the handlers look things up in. A new
+    Policy is built on every reload and swapped in whole.
+    """
+    support_deck_types: FrozenSet[int] = frozenset(SUPPORT_DECK_TYPES)
+    min_votes_to_kick: int = MIN_VOTES_TO_KICK
+    min_votes_to_rotate: int = MIN_VOTES_TO_ROTATE
+    min_votes_to_year: int = MIN_VOTES_TO_YEAR
+    min_votes_to_change_income: int = MIN_VOTES_TO_CHANGE_INCOME
+    max_badwords_before_kick: int = MAX_BADWORDS_BEFORE_KICK
+    num_disconnects_to_ban: int = NUM_DISCONNECTS_IN_N_MINUTES_TO_BAN
+    kicks_before_autoban: int = KICKS_BEFORE_AUTOBAN
+    badwords: Optional[Pattern[str]] = None
+    command_aliases: Tuple[Tuple[str, str], ...] = () # (alias, command)
+    config_overrides: Tuple[Tuple[str, Any], ...] = () # POLICY_CONFIG_FIELDS set for every server
+    server_overrides: Tuple[Tuple[str, Tuple[Tuple[str, Any], ...]], ...] = () # (server name, overrides)
+    files: Tuple[str, ...] = () # watched for changes
+
+    def server_config(self, config: ServerConfig) -> ServerConfig:
+        """`config` with the policy's values for this server applied"""
+        overrides = dict(self.config_overrides)
+        overrides.update(dict(self.server_overrides).get(config.name, ()))
+        return config._replace(**overrides)
+
+def policy_int(value: Any, where: str, field: str) -> int:
+    if isinstance(value, bool):
+        raise ValueError(f'{where}: {field} must be a number')
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'{where}: {field} must be a number')
+
+def policy_overrides(entry: Dict[str, Any], where: str) -> Tuple[Tuple[str, Any], ...]:
+    """The ServerConfig fields set by a policy entry, checked and converted. Raises ValueError"""
+    overrides: List[Tuple[str, Any]] = []
+    if 'min_player_level' in entry:
+        overrides.append(('min_player_level', policy_int(entry['min_player_level'], where, 'min_player_level')))
+    if 'map_pool' in entry:
+        maps = entry['map_pool']
+        if not isinstance(maps, list) or not maps or not all(isinstance(m, str) for m in maps):
+            raise ValueError(f'{where}: map_pool must be a non-empty list of map names')
+        overrides.append(('map_pool', tuple(maps)))
+    if 'lobby_rules' in entry:
+        if not isinstance(entry['lobby_rules'], str):
+            raise ValueError(f'{where}: lobby_rules must be a string')
+        overrides.append(('lobby_rules', entry['lobby_rules']))
+    return tuple(overrides)
+
+def load_policy(path: Optional[str]) -> Policy:
+    """
+    Read the lobby policy, eg:
+        { "min_player_level": 5, "support_deck_types": [197, 85, 133], "min_votes_to_kick": 3,
+          "badwords_path": "badwords.txt", "command_aliases": { "cmds": "commands" },
+          "servers": { "eu1": { "min_player_level": 10, "map_pool": ["Destruction_2x3_Esashi"] } } }
+    Anything left out keeps the defaults from the top of this file, and the
+    badwords come from BADWORDS_PATH unless the policy lists or points to
+    its own. Raises ValueError or OSError on a bad or missing file.
+    """
+    raw: Dict[str, Any] = {}
+    if path:
+        with open(path) as fin:
+            raw = json.load(fin)
+        if not isinstance(raw, dict):
+            raise ValueError(f'{path}: the policy must be a json object')
+    known = set(POLICY_LIMIT_FIELDS) | set(POLICY_CONFIG_FIELDS) | {'support_deck_types', 'badwords', 'badwords_path', 'command_aliases', 'servers'}
+    unknown = set(raw.keys()) - known
+    if unknown:
+        raise ValueError(f'{path}: unknown policy fields: {", ".join(sorted(unknown))}')
+    if not isinstance(raw.get('servers', {}), dict) or not all(isinstance(entry, dict) for entry in raw.get('servers', {}).values()):
+        raise ValueError(f'{path}: servers must map server names to objects')
+    for name, entry in raw.get('servers', {}).items():
+        if set(entry.keys()) - set(POLICY_CONFIG_FIELDS):
+            raise ValueError(f'{path}: servers.{name} may only set: {", ".join(POLICY_CONFIG_FIELDS)}')
+
+    files = [path] if path else []
+    if 'badwords' in raw:
+        words: List[str] = raw['badwords']
+    else:
+        words = []
+        badwords_path = raw.get('badwords_path', BADWORDS_PATH)
+        files.append(badwords_path)
+        if os.path.exists(badwords_path):
+            with open(badwords_path) as badf:
+                words = badf.read().splitlines()
+        else:
+            log.info('no badwords found at: %s', badwords_path)
+    policy = Policy(
+        badwords=compile_badwords(words),
+        command_aliases=tuple(sorted(raw.get('command_aliases', {}).items())),
+        config_overrides=policy_overrides(raw, str(path)),
+        server_overrides=tuple((name, policy_overrides(entry, f'{path}: servers.{name}')) for name, entry in sorted(raw.get('servers', {}).items())),
+        files=tuple(files),
+    )
+    if 'support_deck_types' in raw:
+        if not isinstance(raw['support_deck_types'], list):
+            raise ValueError(f'{path}: support_deck_types must be a list of numbers')
+        policy = policy._replace(support_deck_types=frozenset(policy_int(t, str(path), 'support_deck_types') for t in raw['support_deck_types']))
+    limits: Dict[str, Any] = {field: policy_int(raw[field], str(path), field) for field in POLICY_LIMIT_FIELDS if field in raw}
+    policy = policy._replace(**limits)
+    log.info('loaded policy%s with %d badwords', f' from {path}' if raw else '', len(set(words) - {''}))
+    return policy
+
 class Player:
     """
     Player data structure
     Incapsulates player data manipulation
     """
 
-    def __init__(self, playerid: str, ip: str, port: int) -> None:
+    def __init__(self, playerid: str, ip: str, port: int, server: 'Server') -> None:
         self._id: str = playerid
+        self._server: 'Server' = server
         self._side: Side = Side.Bluefor
         self._ip: str = ip
         self._port: int = port
         self._deck: str = ""
+        self._deck_type: Optional[int] = None
         self._level: int = 0
         self._elo: float = 0.0
         self._name: str = ""
         self.arrival_time: float = time.time()
         self.num_badwords = 0
         self.team_affiliation: Optional[str] = None
-        self.disconnects: List[float] = [] # timestamps of any disconnects
-        self.votes: Dict[str, Dict[Any, bool]] = { 'kick': {}, 'rotate': {}, 'year': {}, 'income': {} }
+        self.votes: Dict[str, Dict[Any, float]] = { 'kick': {}, 'rotate': {}, 'year': {}, 'income': {} } # vote -> time cast
+        self.command_bucket = TokenBucket(PLAYER_COMMANDS_PER_SECOND, PLAYER_COMMAND_BURST)
 
     # Getters
     def get_id(self) -> str:
@@ -149,6 +521,9 @@ class Player:
     def get_deck(self) -> str:
         return self._deck
 
+    def get_deck_type(self) -> Optional[int]:
+        return self._deck_type
+
     def get_level(self) -> int:
         return self._level
 
@@ -164,6 +539,10 @@ class Player:
 
     def set_deck(self, deck: str) -> None:
         self._deck = deck
+        try:
+            self._deck_type = Deck.get_deck_type(deck)
+        except Exception:
+            self._deck_type = None
 
     def set_level(self, level: int) -> None:
         self._level = level
@@ -194,7 +573,7 @@ class Player:
     
     def change_side(self, side: int) -> None:
         """Forcibly change player's side"""
-        Rcon.execute("setpvar " + self._id + " PlayerAlliance " + str(int(side)))
+        self._server.rcon.execute("setpvar " + self._id + " PlayerAlliance " + str(int(side)))
         #if side == Side.Bluefor:
         #    self.change_deck(GENERAL_BLUE_DECK)
         #else:
@@ -202,18 +581,40 @@ class Player:
             
     def change_deck(self, deck: str) -> None:
         """Forcibly assign new deck to a player"""
-        Rcon.execute("setpvar " + self._id + " PlayerDeckContent " + deck)
+        self._server.rcon.execute("setpvar " + self._id + " PlayerDeckContent " + deck)
 
     def kick(self) -> None:
         """Kick player"""
-        Server.kick_player_by_id(self._id)
+        self._server.kick_player_by_id(self._id)
 
     def ban(self) -> None:
         """Ban player"""
-        Server.ban_player_by_id(self._id)
+        self._server.ban_player_by_id(self._id)
     
 
 
+class Roster:
+    """
+    The connected players. Only the log thread changes it, and every change
+    publishes a new read-only dict by swapping one reference; published dicts
+    are never modified. Other threads can iterate `current` without locks or
+    copies, and keep a consistent view for as long as they hold on to it.
+    """
+
+    def __init__(self) -> None:
+        self.current: Mapping[str, Player] = MappingProxyType({})
+
+    def add(self, player: Player) -> None:
+        players = dict(self.current)
+        players[player.get_id()] = player
+        self.current = MappingProxyType(players)
+
+    def remove(self, playerid: str) -> None:
+        players = dict(self.current)
+        del players[playerid]
+        self.current = MappingProxyType(players)
+
+
 class Deck:
 
     @classmethod
@@ -222,25 +623,376 @@ class Deck:
         return bytes[1]
     
     @classmethod
-    def is_support_deck(cls, deck_str: str) -> bool:
+    def is_support_deck(cls, deck_str: str, support_deck_types: Iterable[int]=SUPPORT_DECK_TYPES) -> bool:
         try:
             type_code = Deck.get_deck_type(deck_str)
             #print(bytes[0]) # country
-            return type_code in SUPPORT_DECK_TYPES
+            return type_code in support_deck_types
         except Exception:
-            print(f'invalid deck code: {deck_str}')
+            log.warning('invalid deck code: %s', deck_str)
             return False # default to False, if it's invalid...it can't be support?
 
 
+class TokenBucket:
+    """Refills `rate` tokens per second, holding at most `capacity`"""
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+
+    def try_take(self, tokens: float=1) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+    def time_until_available(self, tokens: float=1) -> float:
+        return max(0.0, (tokens - self.tokens) / self.rate - (time.monotonic() - self.last_refill))
+
+
+def split_chat_message(message: str, max_length: int=MAX_CHAT_LINE_LENGTH) -> List[str]:
+    """Break a message into chunks that fit on one chat line, preferring to split between words"""
+    parts: List[str] = []
+    while len(message) > max_length:
+        cut = message.rfind(' ', 0, max_length + 1)
+        if cut <= 0:
+            cut = max_length
+        parts.append(message[:cut].rstrip())
+        message = message[cut:].lstrip()
+    if message or not parts:
+        parts.append(message)
+    return parts
+
+
+class StatAccumulator(ABC):
+    """
+    One lobby statistic, maintained incrementally. apply() is called with
+    sign=+1 when a player's current values join the totals and sign=-1 when
+    they leave, so every update is O(1) regardless of lobby size.
+    """
+
+    @abstractmethod
+    def apply(self, player: Player, sign: int) -> None:
+        ...
+
+
+class SideTotal(StatAccumulator):
+    """Running sum and count of a numeric player attribute, per side"""
+
+    def __init__(self, value: Callable[[Player], float]) -> None:
+        self.value = value
+        self.sums = [0.0, 0.0]
+        self.counts = [0, 0]
+
+    def apply(self, player: Player, sign: int) -> None:
+        side = int(player.get_side())
+        self.sums[side] += sign * self.value(player)
+        self.counts[side] += sign
+
+    def mean(self, side: Side) -> float:
+        count = self.counts[int(side)]
+        return self.sums[int(side)] / count if count else 0
+
+
+class DeckHistogram(StatAccumulator):
+    """Number of players using each deck type, per side"""
+
+    def __init__(self) -> None:
+        self.counts: List['collections.Counter[int]'] = [collections.Counter(), collections.Counter()]
+
+    def apply(self, player: Player, sign: int) -> None:
+        deck_type = player.get_deck_type()
+        if deck_type is not None:
+            counter = self.counts[int(player.get_side())]
+            counter[deck_type] += sign
+            if counter[deck_type] <= 0:
+                del counter[deck_type]
+
+
+class LobbyStats:
+    """
+    Aggregates over the connected players, kept up to date by the _on_player_*
+    handlers. `version` changes whenever any of them does, so callers can cache
+    anything derived from them. To add a statistic, add an accumulator here.
+    """
+
+    def __init__(self) -> None:
+        self.level = SideTotal(lambda player: player.get_level())
+        self.elo = SideTotal(lambda player: player.get_elo())
+        self.decks = DeckHistogram()
+        self.accumulators: List[StatAccumulator] = [self.level, self.elo, self.decks]
+        self.version = 0
+
+    def add(self, player: Player) -> None:
+        for accumulator in self.accumulators:
+            accumulator.apply(player, 1)
+        self.version += 1
+
+    def remove(self, player: Player) -> None:
+        for accumulator in self.accumulators:
+            accumulator.apply(player, -1)
+        self.version += 1
+
+    def team_size(self, side: Side) -> int:
+        return self.level.counts[int(side)]
+
+
+class BanList:
+    """
+    Bans for one server, checked on every connect.
+
+    Permanent EugNetId bans live in banned_clients.ini, which the game server
+    reads too. Timed bans and IP/CIDR bans are only enforced by this script and
+    live next to it in a json file. Both files are rewritten atomically,
+    deduplicated and without expired bans, instead of appended to. Ids are
+    checked with a dict lookup; networks are flattened into sorted,
+    non-overlapping ranges and checked with a binary search. Changes apply
+    in memory at once; a background thread writes the files.
+    """
+    FOREVER = 0.0
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.extra_path = path + '.extra.json'
+        self.lock = Lock()
+        self.header: List[str] = [] # lines of banned_clients.ini that aren't bans, kept as-is
+        self.ini_bans: Dict[str, str] = {} # EugNetId -> value as written in banned_clients.ini
+        self.timed_bans: Dict[str, float] = {} # EugNetId -> expiry time
+        self.networks: Dict[str, float] = {} # cidr -> expiry time, FOREVER for permanent
+        # (range starts, ranges as (first address, last address, expiry)), swapped as one so readers need no lock
+        self.ranges: Tuple[List[int], List[Tuple[int, int, float]]] = ([], [])
+        self.removed: Set[str] = set() # unbanned, but maybe still in the files
+        self.changed = Event()
+        with self.lock:
+            self.header, self.ini_bans, self.timed_bans, self.networks = self.read_files()
+            self.purge_expired(time.time())
+        log.info('loaded %d id bans and %d network bans for: %s', len(self.ini_bans) + len(self.timed_bans), len(self.networks), self.path)
+        Thread(target=self.run_writer, daemon=True).start()
+
+    def read_files(self) -> Tuple[List[str], Dict[str, str], Dict[str, float], Dict[str, float]]:
+        header: List[str] = []
+        ini_bans: Dict[str, str] = {}
+        timed_bans: Dict[str, float] = {}
+        networks: Dict[str, float] = {}
+        if os.path.exists(self.path):
+            with open(self.path) as fin:
+                for line in fin:
+                    key, sep, value = line.partition('=')
+                    if sep and key.strip().isdigit():
+                        ini_bans[key.strip()] = value.strip()
+                    elif line.strip():
+                        header.append(line.rstrip('\n'))
+        if os.path.exists(self.extra_path):
+            with open(self.extra_path) as fin:
+                extra = json.load(fin)
+            timed_bans.update(extra.get('ids', {}))
+            networks.update(extra.get('networks', {}))
+        return header, ini_bans, timed_bans, networks
+
+    def purge_expired(self, current_time: float) -> None:
+        self.timed_bans = {k: v for k, v in self.timed_bans.items() if v > current_time and k not in self.ini_bans}
+        self.networks = {k: v for k, v in self.networks.items() if v == self.FOREVER or v > current_time}
+        self.build_ranges()
+
+    def build_ranges(self) -> None:
+        """Flatten possibly overlapping networks into disjoint ranges carrying the longest expiry covering them"""
+        intervals = []
+        for cidr, expiry in self.networks.items():
+            net = ipaddress.IPv4Network(cidr, strict=False)
+            intervals.append((int(net.network_address), int(net.broadcast_address), math.inf if expiry == self.FOREVER else expiry))
+        bounds = sorted(set([first for first, _, _ in intervals] + [last + 1 for _, last, _ in intervals]))
+        ranges: List[Tuple[int, int, float]] = []
+        for lo, hi in zip(bounds, bounds[1:]):
+            covering = [expiry for first, last, expiry in intervals if first <= lo and hi - 1 <= last]
+            if not covering:
+                continue
+            expiry = max(covering)
+            if ranges and ranges[-1][1] == lo - 1 and ranges[-1][2] == expiry:
+                ranges[-1] = (ranges[-1][0], hi - 1, expiry)
+            else:
+                ranges.append((lo, hi - 1, expiry))
+        self.ranges = ([first for first, _, _ in ranges], ranges)
+
+    def check(self, playerid: str, ip: str) -> Optional[str]:
+        """Returns why the player is banned, or None"""
+        if playerid in self.ini_bans:
+            return 'banned'
+        current_time = time.time()
+        expiry = self.timed_bans.get(playerid)
+        if expiry is not None and expiry > current_time:
+            return f'banned for another {int((expiry - current_time) / 60) + 1} minutes'
+        starts, ranges = self.ranges
+        if ranges:
+            try:
+                address = int(ipaddress.IPv4Address(ip))
+            except ValueError:
+                return None
+            i = bisect.bisect_right(starts, address) - 1
+            if i >= 0:
+                first, last, expiry = ranges[i]
+                if address <= last and expiry > current_time:
+                    return 'address banned'
+        return None
+
+    def ban(self, playerid: str, duration: Optional[float]=None) -> None:
+        """Ban an EugNetId, forever or for `duration` seconds"""
+        with self.lock:
+            if playerid in self.ini_bans:
+                return
+            self.removed.discard(playerid)
+            if duration is None:
+                self.ini_bans[playerid] = '0' # ban forever
+            else:
+                self.timed_bans[playerid] = max(self.timed_bans.get(playerid, 0), time.time() + duration)
+        self.changed.set()
+
+    def ban_network(self, cidr: str, duration: Optional[float]=None) -> None:
+        """Ban an IP address or CIDR range like '1.2.3.0/24', forever or for `duration` seconds"""
+        cidr = str(ipaddress.IPv4Network(cidr, strict=False))
+        with self.lock:
+            self.removed.discard(cidr)
+            self.networks[cidr] = self.FOREVER if duration is None else time.time() + duration
+            self.build_ranges()
+        self.changed.set()
+
+    def unban(self, playerid_or_cidr: str) -> None:
+        if '/' in playerid_or_cidr or '.' in playerid_or_cidr:
+            playerid_or_cidr = str(ipaddress.IPv4Network(playerid_or_cidr, strict=False))
+        with self.lock:
+            self.removed.add(playerid_or_cidr)
+            self.ini_bans.pop(playerid_or_cidr, None)
+            self.timed_bans.pop(playerid_or_cidr, None)
+            if self.networks.pop(playerid_or_cidr, None) is not None:
+                self.build_ranges()
+        self.changed.set()
+
+    def save(self) -> None:
+        # merge in anything the game server or an admin added since we loaded
+        header, ini_bans, timed_bans, networks = self.read_files()
+        with self.lock:
+            self.header = header
+            self.ini_bans = dict(ini_bans, **self.ini_bans)
+            self.timed_bans = dict(timed_bans, **self.timed_bans)
+            self.networks = dict(networks, **self.networks)
+            for removed in self.removed:
+                self.ini_bans.pop(removed, None)
+                self.timed_bans.pop(removed, None)
+                self.networks.pop(removed, None)
+            self.removed = set()
+            self.purge_expired(time.time())
+            ini = ''.join(line + '\n' for line in self.header) + \
+                ''.join(f'{playerid} = {value}\n' for playerid, value in sorted(self.ini_bans.items()))
+            extra = json.dumps({'ids': self.timed_bans, 'networks': self.networks}, indent=1, sort_keys=True)
+        atomic_write(self.path, ini)
+        atomic_write(self.extra_path, extra)
+
+    def run_writer(self) -> None:
+        """Write the files after changes, off the threads that ban (the log thread, on connect)"""
+        while True:
+            self.changed.wait()
+            self.changed.clear()
+            try:
+                self.save()
+            except (OSError, ValueError) as e:
+                log.error('could not write bans to %s: %s', self.path, e)
+
+
+def atomic_write(path: str, content: str) -> None:
+    """Replace a file's content so readers only ever see the old or the new version"""
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as fout:
+        fout.write(content)
+        fout.flush()
+        os.fsync(fout.fileno())
+    os.replace(tmp_path, path)
+
+
+class ScheduledTask:
+    def __init__(self, due: float, fn: Callable[[], None], interval: Optional[float]) -> None:
+        self.due = due
+        self.fn = fn
+        self.interval = interval
+        self.cancelled = False
+
+    def cancel(self) -> None:
+        self.cancelled = True
+
+
+class Scheduler:
+    """
+    Runs one-shot and periodic tasks on a single thread. Tasks sit in a heap
+    ordered by due time and the thread sleeps until the earliest one, so
+    timing doesn't depend on console input and an idle process doesn't wake up.
+    Tasks should be quick; anything slow belongs on its own thread.
+    """
+
+    def __init__(self) -> None:
+        self.heap: List[Tuple[float, int, ScheduledTask]] = []
+        self.counter = itertools.count() # tie-breaker so tasks themselves are never compared
+        self.condition = Condition()
+        Thread(target=self.run, daemon=True).start()
+
+    def call_later(self, delay: float, fn: Callable[[], None]) -> ScheduledTask:
+        return self.push(ScheduledTask(time.monotonic() + delay, fn, None))
+
+    def call_every(self, interval: float, fn: Callable[[], None], first_delay: Optional[float]=None) -> ScheduledTask:
+        return self.push(ScheduledTask(time.monotonic() + (interval if first_delay is None else first_delay), fn, interval))
+
+    def push(self, task: ScheduledTask) -> ScheduledTask:
+        with self.condition:
+            heapq.heappush(self.heap, (task.due, next(self.counter), task))
+            if self.heap[0][2] is task:
+                self.condition.notify() # new earliest task, shorten the wait
+        return task
+
+    def run(self) -> None:
+        while True:
+            with self.condition:
+                while not self.heap or self.heap[0][0] > time.monotonic():
+                    self.condition.wait(self.heap[0][0] - time.monotonic() if self.heap else None)
+                _, _, task = heapq.heappop(self.heap)
+            if task.cancelled:
+                continue
+            try:
+                task.fn()
+            except Exception:
+                log.exception('scheduled task %s failed', getattr(task.fn, '__name__', task.fn))
+            if task.interval is not None and not task.cancelled:
+                # keep to the original cadence, but don't try to catch up on missed runs
+                task.due = max(task.due + task.interval, time.monotonic())
+                self.push(task)
+
+
 class Server:
     """
     Server data structure
     Incapsulates server manipulation
     """
-    @classmethod
-    def send_message(cls, message: str, from_client_id: int, only_to_client_id:Optional[str]=None) -> None:
-        print(f'[SERVER]: {message}')
-        """Send a message. If not client specified, will go to all clients"""
+    def __init__(self, name: str, rcon: 'Rcon', banned_clients_path: str, journal: Optional['Journal']=None) -> None:
+        self.name = name
+        self.log = log.getChild(name)
+        self.rcon = rcon
+        self.bans = BanList(banned_clients_path)
+        self.journal = journal
+        # outbound chat waiting for the rate limit, oldest first. Keyed by
+        # (to, from, text) so repeats merge, or by (to, from, coalesce_key) so
+        # a newer message replaces an older one of the same kind
+        self.pending_chat: 'collections.OrderedDict[Tuple[int, int, str], List[str]]' = collections.OrderedDict()
+        self.chat_bucket = TokenBucket(CHAT_MESSAGES_PER_SECOND, CHAT_BURST)
+        self.chat_lock = Lock()
+        self.scheduler: Optional[Scheduler] = None
+        self.flush_scheduled = False
+
+    def send_message(self, message: str, from_client_id: int, only_to_client_id:Optional[str]=None, coalesce_key: Optional[str]=None) -> None:
+        """
+        Send a message. If not client specified, will go to all clients.
+        Messages are rate limited; a pending message with the same coalesce_key is replaced by this one.
+        """
         if not only_to_client_id:
             client_id_hex = 0xffffffff # broadcast
         else:
@@ -252,112 +1004,614 @@ class Server:
 
         source_client_id_hex = from_client_id
 
-        # strip the 0x prefix on the hex client id
-        msg = f"chat {'%08x' % client_id_hex} {'%08x' % source_client_id_hex} {message}"
-        Rcon.execute(msg)
+        key = (client_id_hex, source_client_id_hex, 'key:' + coalesce_key if coalesce_key else 'msg:' + message)
+        with self.chat_lock:
+            self.pending_chat[key] = split_chat_message(message)
+            while len(self.pending_chat) > MAX_PENDING_CHAT_MESSAGES:
+                dropped_key, _dropped = self.pending_chat.popitem(last=False)
+                self.log.warning('chat backlog full, dropping: %s', dropped_key[2])
+        self.flush_chat()
+
+    def flush_chat(self) -> None:
+        """Send as many pending chat lines as the rate limit allows, and schedule a retry for the rest"""
+        with self.chat_lock:
+            while self.pending_chat and self.chat_bucket.try_take():
+                key, parts = next(iter(self.pending_chat.items()))
+                client_id_hex, source_client_id_hex, _ = key
+                line = parts.pop(0)
+                if not parts:
+                    del self.pending_chat[key]
+                self.log.info('[SERVER]: %s', line)
+                # strip the 0x prefix on the hex client id
+                self.rcon.execute(f"chat {'%08x' % client_id_hex} {'%08x' % source_client_id_hex} {line}")
+            if self.pending_chat and self.scheduler and not self.flush_scheduled:
+                self.flush_scheduled = True
+                self.scheduler.call_later(self.chat_bucket.time_until_available(), self.scheduled_flush_chat)
+
+    def scheduled_flush_chat(self) -> None:
+        with self.chat_lock:
+            self.flush_scheduled = False
+        self.flush_chat()
         
-    @classmethod
-    def change_map(cls, mapname: str) -> None:
-        Rcon.execute("setsvar Map " + mapname)
+    def change_map(self, mapname: str) -> None:
+        self.rcon.execute("setsvar Map " + mapname)
 
-    @classmethod
-    def change_game_type(cls, game_type: int) -> None:
-        Rcon.execute("setsvar GameType " + str(game_type))
+    def change_game_type(self, game_type: int) -> None:
+        self.rcon.execute("setsvar GameType " + str(game_type))
 
-    @classmethod
-    def change_name(cls, name: str) -> None:
-        Rcon.execute("setsvar ServerName " + name)
+    def change_name(self, name: str) -> None:
+        self.rcon.execute("setsvar ServerName " + name)
 
-    @classmethod
-    def ban_player_by_id(cls, id: str) -> None:
-        Rcon.execute("ban " + id)
-        if os.path.exists('banned_clients.ini'):
-            with open('banned_clients.ini', 'a') as fout:
-                fout.write(f"{id} = 0\n") # ban forever
+    def ban_player_by_id(self, id: str, duration: Optional[float]=None) -> None:
+        """Ban forever, or for `duration` seconds (enforced by kicking on connect)"""
+        if self.journal:
+            self.journal.record(self.name, 'ban', {'player': id, 'duration': duration})
+        if duration is None:
+            self.rcon.execute("ban " + id)
+        else:
+            self.rcon.execute("kick " + id)
+        self.bans.ban(id, duration)
 
-    @classmethod
-    def kick_player_by_id(cls, id: str) -> None:
-        Rcon.execute("kick " + id)
+    def ban_network(self, cidr: str, duration: Optional[float]=None) -> None:
+        """Ban an IP address or range like '1.2.3.0/24'. Enforced by kicking on connect"""
+        if self.journal:
+            self.journal.record(self.name, 'ban', {'network': cidr, 'duration': duration})
+        self.bans.ban_network(cidr, duration)
 
-    @classmethod
-    def change_income_rate(cls, number: int) -> None:
+    def kick_player_by_id(self, id: str) -> None:
+        if self.journal:
+            self.journal.record(self.name, 'kick', {'player': id})
+        self.rcon.execute("kick " + id)
+
+    def change_income_rate(self, number: int) -> None:
         if 0 <= number <= 5:
-            Rcon.execute("setsvar IncomeRate " + str(number))
+            self.rcon.execute("setsvar IncomeRate " + str(number))
         else:
-            print('valid number for income: 0-5')
+            self.log.warning('valid number for income: 0-5')
 
-    @classmethod
-    def change_min_players_to_start(cls, number: int) -> None:
-        Rcon.execute("setsvar NbMinPlayer " + str(number))
+    def change_min_players_to_start(self, number: int) -> None:
+        self.rcon.execute("setsvar NbMinPlayer " + str(number))
         
-    @classmethod
-    def change_time_limit(cls, number: int) -> None:
-        Rcon.execute("setsvar TimeLimit " + str(number))
+    def change_time_limit(self, number: int) -> None:
+        self.rcon.execute("setsvar TimeLimit " + str(number))
 
-    @classmethod
-    def change_max_players(cls, number: int) -> None:
-        Rcon.execute("setsvar NbMaxPlayer " + str(number))
+    def change_max_players(self, number: int) -> None:
+        self.rcon.execute("setsvar NbMaxPlayer " + str(number))
 
-    @classmethod
-    def change_money(cls, number: int) -> None:
-        Rcon.execute("setsvar InitMoney " + str(number))
+    def change_money(self, number: int) -> None:
+        self.rcon.execute("setsvar InitMoney " + str(number))
 
-    @classmethod
-    def change_score_limit(cls, number: int) -> None:
-        Rcon.execute("setsvar ScoreLimit " + str(number))
+    def change_score_limit(self, number: int) -> None:
+        self.rcon.execute("setsvar ScoreLimit " + str(number))
 
-    @classmethod
-    def change_victory_cond(cls, number: int) -> None:
-        Rcon.execute("setsvar VictoryCond " + str(number))
+    def change_victory_cond(self, number: int) -> None:
+        self.rcon.execute("setsvar VictoryCond " + str(number))
 
-    @classmethod
-    def change_date_constraint(cls, number: int) -> None:
-        Rcon.execute("setsvar DateConstraint " + str(number))
+    def change_date_constraint(self, number: int) -> None:
+        self.rcon.execute("setsvar DateConstraint " + str(number))
     
+class CircuitBreaker:
+    """
+    Fails fast after RCON_FAILURES_TO_OPEN consecutive errors, so a hung or
+    restarting server doesn't cost a timeout per command. Once open, one
+    attempt is let through after an exponential backoff with jitter; a
+    success closes it again.
+    """
+
+    def __init__(self) -> None:
+        self.failures = 0
+        self.times_opened = 0
+        self.retry_at = 0.0
+
+    @property
+    def is_open(self) -> bool:
+        return self.failures >= RCON_FAILURES_TO_OPEN
+
+    def allow(self) -> bool:
+        return not self.is_open or time.monotonic() >= self.retry_at
+
+    def success(self) -> None:
+        self.failures = 0
+        self.times_opened = 0
+
+    def failure(self) -> float:
+        """Record an error. Returns the seconds until the next attempt, or 0 while still closed"""
+        self.failures += 1
+        if not self.is_open:
+            return 0.0
+        self.times_opened += 1
+        backoff = min(RCON_BACKOFF_MAX, RCON_BACKOFF_BASE * 2.0 ** (self.times_opened - 1))
+        backoff *= 0.5 + random() / 2 # so servers that went down together don't retry in lockstep
+        self.retry_at = time.monotonic() + backoff
+        return backoff
+
+
 class Rcon:
     """ Rcon connection settings """
-    rcon_host: str = "localhost"
-    rcon_port: str = DEFAULT_RCON_PORT
-    rcon_password: str = DEFAULT_RCON_PASSWORD
+
+    def __init__(self, rcon_host: str="localhost", rcon_port: str=DEFAULT_RCON_PORT,
+                 rcon_password: str=DEFAULT_RCON_PASSWORD, pool: Optional['RconPool']=None,
+                 journal: Optional['Journal']=None, name: str="default") -> None:
+        self.rcon_host = rcon_host
+        self.rcon_port = rcon_port
+        self.rcon_password = rcon_password
+        self.pool = pool
+        self.worker_index = pool.assign_worker(self) if pool else 0
+        self.journal = journal
+        self.name = name
+        self.breaker = CircuitBreaker()
+        self.held: 'collections.deque[str]' = collections.deque() # commands waiting for the server to come back
+        self.lock = Lock()
+
+    def execute(self, command: str) -> None:
+        """Execute rcon command, incapsulating details. Runs on the shared pool if there is one"""
+        if self.journal:
+            self.journal.record(self.name, 'rcon', {'command': command})
+        if self.pool:
+            self.pool.submit(self, command)
+        else:
+            self.run(command)
+
+    def run(self, command: str) -> None:
+        """Send a command unless the server is known to be down, in which case it is held or dropped"""
+        with self.lock:
+            if not self.breaker.allow() or not self.send_held() or not self.try_send(command):
+                self.hold(command)
+
+    def retry_held(self) -> None:
+        """Called periodically by the pool, so held commands go out once the server is back"""
+        with self.lock:
+            if self.held and self.breaker.allow():
+                self.send_held()
+
+    def send_held(self) -> bool:
+        while self.held:
+            if not self.try_send(self.held[0]):
+                return False
+            self.held.popleft()
+        return True
+
+    def try_send(self, command: str) -> bool:
+        was_open = self.breaker.is_open
+        try:
+            self.execute_now(command)
+        except (OSError, PyRconException) as e:
+            retry_in = self.breaker.failure()
+            if retry_in and not was_open:
+                log.error('rcon on port %s is failing (%s), holding commands and retrying in %.1fs', self.rcon_port, e, retry_in)
+            elif not retry_in:
+                log.error('rcon command failed on port %s: %s (%s)', self.rcon_port, command, e)
+            return False
+        if was_open:
+            log.info('rcon on port %s is back', self.rcon_port)
+        self.breaker.success()
+        return True
+
+    def hold(self, command: str) -> None:
+        if command.split(' ', 1)[0] in RCON_DROPPABLE_COMMANDS:
+            log.debug('rcon on port %s is down, dropping: %s', self.rcon_port, command)
+            return
+        if len(self.held) >= RCON_OUTAGE_BUFFER:
+            log.warning('rcon on port %s is down and too many commands are held, dropping: %s', self.rcon_port, self.held.popleft())
+        self.held.append(command)
+
+    def execute_now(self, command: str) -> None:
+        client = PyRcon(RCON_TIMEOUT)
+        try:
+            client.connect(
+                self.rcon_host,
+                self.rcon_port,
+                self.rcon_password,
+            )
+            client.command(command)
+        finally:
+            if client.socket is not None:
+                client.disconnect()
+
+class RconPool:
+    """
+    Small fixed set of worker threads shared by the rcon clients of every server.
+    Each Rcon is pinned to one worker, so commands to the same server keep their order.
+    """
+
+    def __init__(self, num_workers: int) -> None:
+        self.queues: List['queue.Queue[Tuple[Rcon, str]]'] = [queue.Queue() for _ in range(max(1, num_workers))]
+        self.members: List[List[Rcon]] = [[] for _ in self.queues]
+        self.next_worker = 0
+        for index, q in enumerate(self.queues):
+            Thread(target=self.run_worker, args=(q, self.members[index]), daemon=True).start()
+
+    def assign_worker(self, rcon: Rcon) -> int:
+        index = self.next_worker % len(self.queues)
+        self.next_worker += 1
+        self.members[index].append(rcon)
+        return index
+
+    def submit(self, rcon: Rcon, command: str) -> None:
+        self.queues[rcon.worker_index].put((rcon, command))
+
+    def run_worker(self, q: 'queue.Queue[Tuple[Rcon, str]]', members: List[Rcon]) -> None:
+        while True:
+            try:
+                rcon, command = q.get(timeout=RCON_RETRY_POLL)
+            except queue.Empty:
+                for rcon in members:
+                    rcon.retry_held()
+                continue
+            try:
+                rcon.run(command)
+            except Exception as e:
+                log.error('rcon command failed on port %s: %s (%s)', rcon.rcon_port, command, e)
+
+class Journal:
+    """
+    Append-only record of everything the script sees and does, one json object per line:
+        {"t": 1592000000.0, "server": "eu1", "event": "connect", "player": "12345", ...}
+    record() only enqueues; a background thread encodes, writes in batches, fsyncs
+    at most every JOURNAL_FSYNC_INTERVAL seconds and starts a new numbered segment
+    file once the current one reaches JOURNAL_SEGMENT_BYTES.
+    """
+    FILE_PREFIX = 'journal-'
+    FILE_SUFFIX = '.jsonl'
+
+    def __init__(self, directory: str, segment_bytes: int=JOURNAL_SEGMENT_BYTES) -> None:
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.records: 'queue.Queue[Tuple[float, str, str, Dict[str, Any]]]' = queue.Queue(JOURNAL_QUEUE_SIZE)
+        self.dropped = 0
+        os.makedirs(directory, exist_ok=True)
+        # never append to a segment a previous run may have left half-written
+        self.segment = max(self.list_segments(directory), default=0)
+        self.fout: Optional[IO[str]] = None
+        self.segment_size = 0
+        Thread(target=self.run_writer, daemon=True).start()
+
+    def record(self, server: str, event: str, fields: Dict[str, Any]) -> None:
+        """Never blocks: if the writer can't keep up, the record is counted and dropped"""
+        try:
+            self.records.put_nowait((time.time(), server, event, fields))
+        except queue.Full:
+            self.dropped += 1
 
     @classmethod
-    def execute(cls, command: str) -> None:
-        """Execute rcon command, incapsulating details"""
-        client = PyRcon()
-        client.connect(
-            cls.rcon_host,
-            cls.rcon_port,
-            cls.rcon_password,
-        )
-        return client.command(command)
+    def list_segments(cls, directory: str) -> List[int]:
+        segments = []
+        for filename in os.listdir(directory):
+            number = filename[len(cls.FILE_PREFIX):-len(cls.FILE_SUFFIX)]
+            if filename.startswith(cls.FILE_PREFIX) and filename.endswith(cls.FILE_SUFFIX) and number.isdigit():
+                segments.append(int(number))
+        return sorted(segments)
+
+    def segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, f'{self.FILE_PREFIX}{segment:06d}{self.FILE_SUFFIX}')
+
+    def open_next_segment(self) -> IO[str]:
+        if self.fout:
+            self.fout.flush()
+            os.fsync(self.fout.fileno())
+            self.fout.close()
+            self.fout = None
+        self.segment += 1
+        self.fout = open(self.segment_path(self.segment), 'a', encoding='utf-8')
+        self.segment_size = 0
+        return self.fout
+
+    def run_writer(self) -> None:
+        last_sync = time.monotonic()
+        dirty = False
+        while True:
+            batch: List[Tuple[float, str, str, Dict[str, Any]]] = []
+            try:
+                batch.append(self.records.get(timeout=JOURNAL_FSYNC_INTERVAL))
+                while len(batch) < JOURNAL_BATCH_SIZE:
+                    batch.append(self.records.get_nowait())
+            except queue.Empty:
+                pass
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                batch.append((time.time(), '', 'journal_dropped', {'count': dropped}))
+            try:
+                # a failed write or rotation leaves no segment open, try a new one
+                fout = self.fout or self.open_next_segment()
+                for t, server, event, fields in batch:
+                    try:
+                        line = json.dumps({'t': round(t, 3), 'server': server, 'event': event, **fields}, separators=(',', ':')) + '\n'
+                    except (TypeError, ValueError) as e:
+                        log.error('could not encode journal record %s: %s', event, e)
+                        continue
+                    fout.write(line)
+                    self.segment_size += len(line)
+                    dirty = True
+                if self.segment_size >= self.segment_bytes:
+                    self.open_next_segment()
+                    last_sync = time.monotonic()
+                    dirty = False
+                elif dirty and time.monotonic() - last_sync >= JOURNAL_FSYNC_INTERVAL:
+                    fout.flush()
+                    os.fsync(fout.fileno())
+                    last_sync = time.monotonic()
+                    dirty = False
+            except OSError as e:
+                log.error('could not write journal to %s: %s', self.directory, e)
+
+class Reputation:
+    """What we remember about a player across sessions and restarts"""
+
+    def __init__(self, playerid: str) -> None:
+        self.playerid = playerid
+        self.name = ""
+        self.num_badwords = 0 # lifetime totals, for the record
+        self.kicks = 0
+        self.bans = 0
+        self.disconnects: List[float] = [] # timestamps of recent disconnects
+        self.kick_times: List[float] = [] # timestamps of recent kicks
+        self.badword_times: List[float] = [] # timestamps of recent badwords
+        self.last_seen = 0.0
+
+    def recent_disconnects(self, current_time: float) -> List[float]:
+        return [t for t in self.disconnects if current_time - t <= DISCONNECTS_IN_LAST_N_MINUTES_TO_BAN * 60]
+
+    def recent_kicks(self, current_time: float) -> List[float]:
+        return [t for t in self.kick_times if current_time - t <= KICK_MEMORY_SECONDS]
+
+    def recent_badwords(self, current_time: float) -> List[float]:
+        return [t for t in self.badword_times if current_time - t <= BADWORD_MEMORY_SECONDS]
+
+
+class ReputationStore:
+    """
+    Player reputation keyed by EugNetId, shared by every server in the process.
+    Everything is loaded into memory at startup so lookups on connect never touch
+    the disk; changes are marked dirty and written back in one transaction every
+    REPUTATION_FLUSH_INTERVAL seconds by a background thread (SQLite in WAL mode).
+    With no path, the store is in-memory only.
+    """
+
+    def __init__(self, path: Optional[str]=None) -> None:
+        self.path = path
+        self.cache: Dict[str, Reputation] = {}
+        self.dirty: Dict[str, Reputation] = {}
+        self.lock = Lock()
+        if path:
+            db = self.connect()
+            for row in db.execute('SELECT id, name, num_badwords, kicks, bans, disconnects, last_seen, kick_times, badword_times FROM reputation'):
+                rep = Reputation(row[0])
+                rep.name, rep.num_badwords, rep.kicks, rep.bans = row[1], row[2], row[3], row[4]
+                rep.disconnects = json.loads(row[5])
+                rep.last_seen = row[6]
+                rep.kick_times = json.loads(row[7] or '[]')
+                rep.badword_times = json.loads(row[8] or '[]')
+                self.cache[rep.playerid] = rep
+            db.close()
+            log.info('loaded reputation for %d players from: %s', len(self.cache), path)
+            Thread(target=self.run_writer, daemon=True).start()
+
+    def connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(cast(str, self.path))
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.execute('CREATE TABLE IF NOT EXISTS reputation (id TEXT PRIMARY KEY, name TEXT, num_badwords INTEGER, '
+                   'kicks INTEGER, bans INTEGER, disconnects TEXT, last_seen REAL, kick_times TEXT, badword_times TEXT)')
+        columns = {row[1] for row in db.execute('PRAGMA table_info(reputation)')}
+        for column in ('kick_times', 'badword_times'): # added later, older kicks and badwords are simply forgotten
+            if column not in columns:
+                db.execute(f'ALTER TABLE reputation ADD COLUMN {column} TEXT')
+        return db
+
+    def get(self, playerid: str) -> Optional[Reputation]:
+        return self.cache.get(playerid)
+
+    def update(self, playerid: str, change: Callable[[Reputation], None]) -> Reputation:
+        """Apply a change to a player's reputation (creating it if needed) and queue it for writing"""
+        with self.lock:
+            rep = self.cache.get(playerid)
+            if rep is None:
+                rep = self.cache[playerid] = Reputation(playerid)
+            change(rep)
+            self.dirty[playerid] = rep
+        return rep
+
+    def record_seen(self, playerid: str, name: str) -> None:
+        def change(rep: Reputation) -> None:
+            rep.name = name
+            rep.last_seen = time.time()
+        self.update(playerid, change)
+
+    def record_badword(self, playerid: str) -> int:
+        """Returns the number of recent badwords, this one included"""
+        current_time = time.time()
+        def change(rep: Reputation) -> None:
+            rep.num_badwords += 1
+            rep.badword_times = rep.recent_badwords(current_time) + [current_time]
+        return len(self.update(playerid, change).badword_times)
+
+    def record_kick(self, playerid: str) -> None:
+        def change(rep: Reputation) -> None:
+            current_time = time.time()
+            rep.kicks += 1
+            rep.kick_times = rep.recent_kicks(current_time) + [current_time]
+        self.update(playerid, change)
+
+    def record_ban(self, playerid: str) -> None:
+        def change(rep: Reputation) -> None:
+            rep.bans += 1
+            rep.kick_times = [] # the ban settles them
+        self.update(playerid, change)
+
+    def forgive(self, playerid: str) -> None:
+        """Forget the recent kicks, badwords and disconnects that would get a player kicked or banned again"""
+        def change(rep: Reputation) -> None:
+            rep.kick_times = []
+            rep.badword_times = []
+            rep.disconnects = []
+        if playerid in self.cache:
+            self.update(playerid, change)
+
+    def record_disconnect(self, playerid: str) -> None:
+        def change(rep: Reputation) -> None:
+            current_time = time.time()
+            rep.disconnects = rep.recent_disconnects(current_time) + [current_time]
+            rep.last_seen = current_time
+        self.update(playerid, change)
+
+    def prune(self) -> None:
+        """Forget disconnects, kicks and badwords that are too old to count towards a ban or kick"""
+        current_time = time.time()
+        with self.lock:
+            for rep in self.cache.values():
+                disconnects = rep.recent_disconnects(current_time)
+                kicks = rep.recent_kicks(current_time)
+                badwords = rep.recent_badwords(current_time)
+                if (len(disconnects), len(kicks), len(badwords)) != (len(rep.disconnects), len(rep.kick_times), len(rep.badword_times)):
+                    rep.disconnects, rep.kick_times, rep.badword_times = disconnects, kicks, badwords
+                    self.dirty[rep.playerid] = rep
+
+    def flush(self, db: sqlite3.Connection) -> None:
+        with self.lock:
+            rows = [(rep.playerid, rep.name, rep.num_badwords, rep.kicks, rep.bans, json.dumps(rep.disconnects), rep.last_seen,
+                     json.dumps(rep.kick_times), json.dumps(rep.badword_times))
+                    for rep in self.dirty.values()]
+            self.dirty = {}
+        if rows:
+            with db:
+                db.executemany('INSERT OR REPLACE INTO reputation (id, name, num_badwords, kicks, bans, disconnects, last_seen, '
+                               'kick_times, badword_times) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def run_writer(self) -> None:
+        db = self.connect()
+        while True:
+            time.sleep(REPUTATION_FLUSH_INTERVAL)
+            try:
+                self.flush(db)
+            except sqlite3.Error as e:
+                log.error('could not write reputation to %s: %s', self.path, e)
+
+class ChatCommand(NamedTuple):
+    """
+    A command players can type in chat. `handler` gets the player and the
+    whole message; commands that take an argument only match when there is
+    one. `rate` limits the command across all players, on top of each
+    player's own limit.
+    """
+    handler: Callable[[Player, str], None]
+    takes_argument: bool = False
+    rate: Optional[float] = None # per second
+    burst: float = 1
+
+
+class ResponseCache:
+    """
+    Answers to chat commands, keyed by command and the game state version
+    they were computed from, so repeating a command doesn't redo the work
+    until something it depends on changes. Also remembers what was last
+    sent per command, so an identical answer isn't broadcast again within
+    RESPONSE_REPEAT_SECONDS.
+    """
+
+    def __init__(self) -> None:
+        self.answers: Dict[str, Tuple[int, str]] = {}
+        self.sent: Dict[str, Tuple[str, float]] = {}
+
+    def get(self, command: str, version: int, compute: Callable[[], Optional[str]]) -> Optional[str]:
+        answer = self.answers.get(command)
+        if answer and answer[0] == version:
+            return answer[1]
+        text = compute()
+        if text is not None:
+            self.answers[command] = (version, text)
+        return text
+
+    def should_send(self, command: str, text: str) -> bool:
+        now = time.monotonic()
+        last = self.sent.get(command)
+        if last and last[0] == text and now - last[1] < RESPONSE_REPEAT_SECONDS:
+            return False
+        self.sent[command] = (text, now)
+        return True
+
+
+class LagWatchdog:
+    """
+    Tracks how far a game's handlers are behind its server log, and switches
+    to degraded mode while they are too far behind to act on fresh state.
+    Lag is the unread part of the log, and how long the current batch of
+    lines has been in the works (the log has no timestamps of its own).
+    Degraded mode ends once a batch leaves little unread and finishes quickly.
+    """
+
+    def __init__(self, game_log: logging.Logger) -> None:
+        self.log = game_log
+        self.is_degraded = False
+        self.batch_started: Optional[float] = None
+        self.on_change: Optional[Callable[[bool], None]] = None
+
+    def start_batch(self, pending_bytes: int) -> None:
+        self.batch_started = time.monotonic()
+        if pending_bytes > LAG_BYTES_THRESHOLD:
+            self.set_degraded(True, f'{pending_bytes} bytes of log to catch up on')
+
+    def end_batch(self, remaining_bytes: int) -> None:
+        elapsed = time.monotonic() - self.batch_started if self.batch_started is not None else 0.0
+        self.batch_started = None
+        if remaining_bytes > LAG_BYTES_THRESHOLD or elapsed > LAG_SECONDS_THRESHOLD:
+            self.set_degraded(True, f'{remaining_bytes} bytes unread, last batch took {elapsed:.1f}s')
+        elif remaining_bytes < LAG_BYTES_THRESHOLD / 4 and elapsed < LAG_SECONDS_THRESHOLD / 4:
+            self.set_degraded(False, 'caught up')
+
+    @property
+    def degraded(self) -> bool:
+        if not self.is_degraded and self.batch_started is not None and time.monotonic() - self.batch_started > LAG_SECONDS_THRESHOLD:
+            self.set_degraded(True, f'batch running for over {LAG_SECONDS_THRESHOLD}s')
+        return self.is_degraded
+
+    def set_degraded(self, degraded: bool, reason: str) -> None:
+        if degraded == self.is_degraded:
+            return
+        self.is_degraded = degraded
+        if degraded:
+            self.log.warning('falling behind the server log (%s): skipping stats, balance suggestions and geo lookups', reason)
+        else:
+            self.log.info('leaving degraded mode: %s', reason)
+        if self.on_change:
+            self.on_change(degraded)
+
 
 class Game:
     """Main class, containing game process manipulation"""
     lines_processed = 0 # number of lines read from the serverlog.txt
+    currentMap: Optional[str] # declared here since a handler above __init__ assigns it
+    message_host: Optional[str] # cached sender for in-game messages, likewise
 
     # -------------------------------------------
     # User event handlers
     # -------------------------------------------
     
     def on_player_connect(self, playerid: str) -> None:
-        known_player = self.known_players.get(playerid)
+        known_player = self.reputation.get(playerid)
         if known_player:
             current_time = time.time()
-            print(f'for {known_player.get_name()} disconnects are {[int(current_time - t) for t in known_player.disconnects]}')
-            known_player.disconnects = [t for t in known_player.disconnects if current_time - t <= DISCONNECTS_IN_LAST_N_MINUTES_TO_BAN * 60]
-            if len(known_player.disconnects) >= NUM_DISCONNECTS_IN_N_MINUTES_TO_BAN:
-                self.send_message(f'player {known_player.get_name()} banned for excessive leave/join behavior', lobby_only=True)
-                known_player.ban()
+            name = known_player.name or playerid
+            if self.log.isEnabledFor(logging.DEBUG):
+                self.log.debug('for %s disconnects are %s', name, [int(current_time - t) for t in known_player.disconnects])
+            if len(known_player.recent_disconnects(current_time)) >= self.policy.num_disconnects_to_ban:
+                self.send_message(f'player {name} banned for excessive leave/join behavior', lobby_only=True)
+                self.ban_player(playerid)
+                return
+            kicks = len(known_player.recent_kicks(current_time))
+            if kicks >= self.policy.kicks_before_autoban:
+                self.send_message(f'player {name} banned for {AUTOBAN_SECONDS // 3600} hours: kicked {kicks} times recently', lobby_only=True)
+                self.ban_player(playerid, AUTOBAN_SECONDS)
+                return
 
         else: # new player, send them the rules
-            pass #Server.send_message(LOBBY_RULES, playerid)
+            pass #self.server.send_message(self.config.get_lobby_rules(), playerid)
 
         # if we now have n-1 or n-2 clients, let's autobalance
-        if self.minPlayersToStart > 0 and len(self.players) >= self.minPlayersToStart - 2:
+        if self.minPlayersToStart > 0 and len(self.players) >= self.minPlayersToStart - 2 and not self.watchdog.degraded:
             self.balance(execute=False) # TODO
 
     def on_player_deck_set(self, playerid: str, playerdeck: str) -> None:
-        if Deck.is_support_deck(playerdeck):
+        if Deck.is_support_deck(playerdeck, self.policy.support_deck_types):
             p = self.players.get(playerid)
             if p:
                 p.set_default_deck()
@@ -367,48 +1621,41 @@ class Game:
         # find the player id
         from_player = self.players.get(client_id)
         if not from_player:
-            print('error: player not found for id: ' + client_id)
+            self.log.warning('player not found for id: %s', client_id)
             return
 
-        print('[' + str(from_player.get_id()) + ':' + from_player.get_name() + ']: ' + msg)
+        self.log.info('[%s:%s]: %s', from_player.get_id(), from_player.get_name(), msg)
+        self.journal_event('chat', player=client_id, message=msg)
+
+        badwords = self.policy.badwords
+        found = badwords.search(msg.lower()) if badwords else None
+        if found:
+            badword = found.group(0)
+            from_player.num_badwords = self.reputation.record_badword(client_id)
+            self.journal_event('badword', player=client_id, badword=badword, count=from_player.num_badwords)
+            if from_player.num_badwords > self.policy.max_badwords_before_kick:
+                self.send_message(f'player {from_player.get_name()} kicked for language')
+                self.reputation.record_kick(client_id)
+                from_player.kick()
+            else:
+                self.log.info('player %s used badword: %s', from_player.get_name(), badword)
 
-        for badword in self.badwords.keys():
-            if badword in msg.lower():
-                from_player.num_badwords += 1
-                if from_player.num_badwords > MAX_BADWORDS_BEFORE_KICK:
-                    self.send_message(f'player {from_player.get_name()} kicked for language')
-                    from_player.kick()
-                else:
-                    print(f'player {from_player.get_name()} used badword: {badword}')
-                break
-        
-        if msg == 'rules':
-            print('sending rules')
-            self.send_message(LOBBY_RULES)
-        elif msg.startswith('kick '):
-            self.handle_kick_request(msg, from_player)
-        elif msg.startswith('team '):
-            self.handle_team_affiliation(msg, from_player)
-        elif msg == 'stats':
-            self.message_average_team_info(True)
-        elif msg in ['commands', 'command', 'cmd', 'comand', 'comands', "'commands'", '"commands"']:
-            self.send_message(COMMANDS_LIST)
-        elif msg == 'rotate':
-            self.handle_rotate_request(from_player)
-        elif msg == 'balance':
-            self.handle_balance_request(from_player)
-        elif msg.startswith('year '):
-            self.handle_year_request(msg, from_player)
-        elif msg.startswith('income '):
-            self.handle_income_request(msg, from_player)
-        elif msg == 'wherefrom':
-            s = []
-            for player in self.players.values():
-                match = geolite2.lookup(player.get_ip())
-                if match:
-                    suffix = match.country #COUNTRY_FLAGS.get(match.country, match.country)
-                    s.append(f'{player.get_name()}: {suffix}')
-            self.send_message(', '.join(s), lobby_only=False)
+        self.run_chat_command(from_player, msg)
+
+    def run_chat_command(self, from_player: Player, msg: str) -> None:
+        """Look the first word up in the command table, and run it if neither the player nor the command is over its rate limit"""
+        word, _, argument = msg.partition(' ')
+        command = self.commands.get(word)
+        if command is None or command.takes_argument != bool(argument):
+            return
+        if not from_player.command_bucket.try_take():
+            self.log.info('dropping %s from %s: too many commands', word, from_player.get_name())
+            return
+        bucket = self.command_buckets.get(command)
+        if bucket and not bucket.try_take():
+            self.log.info('dropping %s from %s: %s was used too recently', word, from_player.get_name(), word)
+            return
+        command.handler(from_player, msg)
 
 
     def on_player_level_set(self, playerid: str, playerlevel: int) -> None:
@@ -427,13 +1674,13 @@ class Game:
         pass
 
     def on_switch_to_game(self) -> None:
-        self.send_message(LOBBY_RULES)
+        self.send_message(self.config.get_lobby_rules())
 
     def on_switch_to_debriefing(self) -> None:
         self.map_random_rotate()
 
     def on_switch_to_deployment(self) -> None:
-        self.send_message(LOBBY_RULES)
+        self.send_message(self.config.get_lobby_rules())
 
     def on_switch_to_lobby(self) -> None:
         pass
@@ -456,18 +1703,44 @@ class Game:
                     acc +=1
         return acc
 
-    def send_message(self, message: str, lobby_only: bool=False) -> None:
+    def cast_vote(self, player: Player, category: str, value: Any) -> None:
+        cast_at = time.time()
+        player.votes[category][value] = cast_at
+        if self.scheduler:
+            self.scheduler.call_later(VOTE_EXPIRY_SECONDS, lambda: self.expire_vote(player, category, value, cast_at))
+
+    def expire_vote(self, player: Player, category: str, value: Any, cast_at: float) -> None:
+        # the vote may have been used up, or cast again since
+        if player.votes[category].get(value) == cast_at:
+            del player.votes[category][value]
+
+    def send_message(self, message: str, lobby_only: bool=False, coalesce_key: Optional[str]=None) -> None:
         # who is the message from?
         if lobby_only or self.gameState == GameState.Lobby:
-            Server.send_message(message, NON_EXISTENT_CLIENT_ID)
+            self.server.send_message(message, NON_EXISTENT_CLIENT_ID, coalesce_key=coalesce_key)
         else:
-            possible_hosts = list(self.players.keys())
-            if len(possible_hosts):
-                host = sorted(possible_hosts)[0]
-                print(f'selected host {self.players[host].get_id()} for message {message}')
-                Server.send_message(message, int(self.players[host].get_id()))
+            host = self.get_message_host()
+            if host:
+                self.server.send_message(message, int(host), coalesce_key=coalesce_key)
                 # at least it will show up in the lobby so that I can see it
-                Server.send_message(message, NON_EXISTENT_CLIENT_ID)
+                self.server.send_message(message, NON_EXISTENT_CLIENT_ID, coalesce_key=coalesce_key)
+
+    def get_message_host(self) -> Optional[str]:
+        """In-game messages have to come from a connected player, use the lowest id. Cached until they leave"""
+        if self.message_host not in self.players:
+            self.message_host = min(self.players.keys()) if self.players else None
+            if self.message_host:
+                self.log.debug('selected host %s for in-game messages', self.message_host)
+        return self.message_host
+
+    def ban_player(self, playerid: str, duration: Optional[float]=None) -> None:
+        self.reputation.record_ban(playerid)
+        self.server.ban_player_by_id(playerid, duration)
+
+    def unban_player(self, playerid: str) -> None:
+        """Lift a ban, and forget the history that would get the player banned again on connect"""
+        self.server.bans.unban(playerid)
+        self.reputation.forgive(playerid)
 
     def find_player_id_by_name(self, name: str, strict: bool=True) -> Optional[Player]:
         for player in self.players.values():
@@ -485,36 +1758,64 @@ class Game:
                 return player
         return None
 
+    def respond(self, command: str, compute: Callable[[], Optional[str]], lobby_only: bool=False) -> None:
+        """Answer a chat command, reusing the last answer if the game state hasn't changed since"""
+        text = self.responses.get(command, self.state_version, compute)
+        if text and self.responses.should_send(command, text):
+            self.send_message(text, lobby_only=lobby_only, coalesce_key='response:' + command)
+
+    def handle_rules_request(self, from_player: Player) -> None:
+        self.log.debug('sending rules')
+        self.respond('rules', self.config.get_lobby_rules)
+
+    def handle_wherefrom_request(self, from_player: Player) -> None:
+        if self.watchdog.degraded:
+            return
+        def compute() -> str:
+            s = []
+            for player in self.players.values():
+                match = geolite2.lookup(player.get_ip())
+                if match:
+                    suffix = match.country #COUNTRY_FLAGS.get(match.country, match.country)
+                    s.append(f'{player.get_name()}: {suffix}')
+            return ', '.join(s)
+        self.respond('wherefrom', compute)
+
     def handle_balance_request(self, from_player: Player) -> None:
-        self.balance()
+        if self.watchdog.degraded:
+            return
+        self.respond('balance', lambda: self.balance(quiet=True), lobby_only=True)
 
     def handle_team_affiliation(self, msg: str, from_player: Player) -> None:
         team_requested = msg.split(' ')[1]
         from_player.team_affiliation = team_requested
+        self.state_version += 1 # changes the balance
         self.send_message(f'in autobalance, {from_player.get_name()} will stay on the same side as all players on: {team_requested}', lobby_only=True)
     
     def handle_rotate_request(self, from_player: Player) -> None:
-        from_player.votes['rotate'][1] = True
+        self.cast_vote(from_player, 'rotate', 1)
         nvotes = self.count_votes('rotate', 1, same_team=False)
-        nvotes_needed = min(MIN_VOTES_TO_ROTATE, len(self.players))
+        nvotes_needed = min(self.policy.min_votes_to_rotate, len(self.players))
+        self.journal_event('vote', player=from_player.get_id(), category='rotate', value=None, votes=nvotes, needed=nvotes_needed)
         if nvotes >= nvotes_needed:
             self.map_random_rotate()
             for player in self.players.values():
                 player.votes['rotate'] = {}
         else:
-            self.send_message(str(nvotes) + '/' + str(nvotes_needed) + ' votes to rotate', lobby_only=True)
+            self.send_message(str(nvotes) + '/' + str(nvotes_needed) + ' votes to rotate', lobby_only=True, coalesce_key='vote:rotate')
 
     def handle_year_request(self, msg: str, from_player: Player) -> None:
         year = msg.split(' ')[1]
         if year not in YEAR_MAP:
             self.send_message("Unknown year, options are: " + ', '.join(YEAR_MAP.keys()), lobby_only=True)
             return
-        from_player.votes['year'][year] = True
+        self.cast_vote(from_player, 'year', year)
         nvotes = self.count_votes('year', year, same_team=False)
-        nvotes_needed = min(MIN_VOTES_TO_YEAR, len(self.players))
-        self.send_message(str(nvotes) + '/' + str(nvotes_needed) + ' votes to set year to: ' + year, lobby_only=True)
+        nvotes_needed = min(self.policy.min_votes_to_year, len(self.players))
+        self.journal_event('vote', player=from_player.get_id(), category='year', value=year, votes=nvotes, needed=nvotes_needed)
+        self.send_message(str(nvotes) + '/' + str(nvotes_needed) + ' votes to set year to: ' + year, lobby_only=True, coalesce_key='vote:year:' + year)
         if nvotes >= nvotes_needed:
-            Server.change_date_constraint(YEAR_MAP[year])
+            self.server.change_date_constraint(YEAR_MAP[year])
             # after that, we need to force all the decks -- this kicks people with the wrong year though!
             # self.assign_decks()
             for player in self.players.values():
@@ -525,12 +1826,13 @@ class Game:
         if newincome not in INCOME_MAP:
             self.send_message("Unknown income, options are: " + ', '.join(INCOME_MAP.keys()), lobby_only=True)
             return
-        from_player.votes['income'][newincome] = True
+        self.cast_vote(from_player, 'income', newincome)
         nvotes = self.count_votes('income', newincome, same_team=False)
-        nvotes_needed = min(MIN_VOTES_TO_CHANGE_INCOME, len(self.players))
-        self.send_message(str(nvotes) + '/' + str(nvotes_needed) + ' votes to set income to: ' + newincome, lobby_only=True)
+        nvotes_needed = min(self.policy.min_votes_to_change_income, len(self.players))
+        self.journal_event('vote', player=from_player.get_id(), category='income', value=newincome, votes=nvotes, needed=nvotes_needed)
+        self.send_message(str(nvotes) + '/' + str(nvotes_needed) + ' votes to set income to: ' + newincome, lobby_only=True, coalesce_key='vote:income:' + newincome)
         if nvotes >= nvotes_needed:
-            Server.change_income_rate(INCOME_MAP[newincome])
+            self.server.change_income_rate(INCOME_MAP[newincome])
             for player in self.players.values():
                 player.votes['income'] = {}
 
@@ -539,13 +1841,15 @@ class Game:
         parts = msg[len('kick '):]
         kickable_player = self.find_player_id_by_name(parts, strict=False)
         if kickable_player:
-            from_player.votes['kick'][kickable_player.get_id()] = True
+            self.cast_vote(from_player, 'kick', kickable_player.get_id())
             nvotes = self.count_votes('kick', kickable_player.get_id(), same_team=True)
+            self.journal_event('vote', player=from_player.get_id(), category='kick', value=kickable_player.get_id(), votes=nvotes, needed=self.policy.min_votes_to_kick)
             if kickable_player.get_side() == from_player.get_side():
-                self.send_message(str(nvotes) + '/' + str(MIN_VOTES_TO_KICK) + ' votes from same team to kick ' + kickable_player.get_name())
+                self.send_message(str(nvotes) + '/' + str(self.policy.min_votes_to_kick) + ' votes from same team to kick ' + kickable_player.get_name(), coalesce_key='vote:kick:' + kickable_player.get_id())
             else:
                 self.send_message('kick vote rejected: not on same team')
-            if nvotes >= MIN_VOTES_TO_KICK:
+            if nvotes >= self.policy.min_votes_to_kick:
+                self.reputation.record_kick(kickable_player.get_id())
                 kickable_player.kick()
                 for player in self.players.values():
                     if kickable_player.get_id() in player.votes['kick']:
@@ -566,19 +1870,21 @@ class Game:
 
     def map_random_rotate(self) -> None:
         """Rotate maps from the pool, making sure not to select the same one again!"""
+        map_pool = self.config.map_pool
         new_id = self.currentMapId
-        while self.currentMapId == new_id:
-            new_id = math.floor(len(MAP_POOL) * random())
-        Server.change_map(MAP_POOL[new_id])
-        print(f"Rotating map to {MAP_POOL[new_id]}")
+        while self.currentMapId == new_id and len(map_pool) > 1:
+            new_id = math.floor(len(map_pool) * random())
+        self.server.change_map(map_pool[new_id])
+        self.log.info('rotating map to %s', map_pool[new_id])
 
     def limit_level(self, playerid: str, playerlevel: int) -> None:
         """Kick players below certain level"""
-        limit = MIN_PLAYER_LEVEL
-        if playerlevel < limit:
-            msg = (f'{self.players[playerid].get_name()} level ({playerlevel}) is too low, minimum is {limit}. Sorry! Kicking...')
+        limit = self.config.min_player_level
+        player = self.players.get(playerid)
+        if player and playerlevel < limit:
+            msg = (f'{player.get_name()} level ({playerlevel}) is too low, minimum is {limit}. Sorry! Kicking...')
             self.send_message(msg, lobby_only=True)
-            self.players[playerid].kick()
+            player.kick()
 
 # ----------------------------------------------------------------------------------------------------------------------
 # --------------------------------------- INTERNAL IMPLEMENTATION DETAILS ----------------------------------------------
@@ -594,25 +1900,44 @@ class Game:
         player_port = match_obj.group(3) 
         # Creating player data structure if not present
         if not (playerid in self.players):
-            print(f"connected player {playerid}")
-            self.players[playerid] = Player(playerid, player_ip, int(player_port))
+            self.log.info('connected player %s', playerid)
+            player = Player(playerid, player_ip, int(player_port), self.server)
+            known_player = self.reputation.get(playerid)
+            if known_player:
+                player.num_badwords = len(known_player.recent_badwords(time.time()))
+            self.stats.add(player)
+            self.roster.add(player)
+            self.message_host = None # the new player may have a lower id
         
 
         if not self.infoRun:
+            self.journal_event('connect', player=playerid, ip=player_ip, port=int(player_port))
+            ban_reason = self.server.bans.check(playerid, player_ip)
+            if ban_reason:
+                self.log.info('kicking %s (%s) on connect: %s', playerid, player_ip, ban_reason)
+                self.server.kick_player_by_id(playerid)
+                return
             self.on_player_connect(playerid)
 
+    def update_player(self, player: Player, change: Callable[[Player], None]) -> None:
+        """Change a connected player, keeping the lobby stats in step"""
+        self.stats.remove(player)
+        change(player)
+        self.stats.add(player)
+
     # ----------------------------------------------
     def _on_player_deck_set(self, match_obj: Match[str]) -> None:
         playerid = match_obj.group(1)
         playerdeck = match_obj.group(2)
 
         if playerid not in self.players:
-            print(f'warn: player id {playerid} not found')
+            self.log.warning('player id %s not found', playerid)
             return None
 
-        self.players[playerid].set_deck(playerdeck)
+        self.update_player(self.players[playerid], lambda p: p.set_deck(playerdeck))
 
         if not self.infoRun:
+            self.journal_event('deck', player=playerid, deck=playerdeck)
             self.on_player_deck_set(playerid, playerdeck)
 
     # ----------------------------------------------
@@ -621,13 +1946,14 @@ class Game:
         playerlevel = match_obj.group(2)
 
         if playerid not in self.players:
-            print(f'warn: player id {playerid} not found')
+            self.log.warning('player id %s not found', playerid)
             return None
 
 
-        self.players[playerid].set_level(int(playerlevel))
+        self.update_player(self.players[playerid], lambda p: p.set_level(int(playerlevel)))
 
         if not self.infoRun:
+            self.journal_event('level', player=playerid, level=int(playerlevel))
             self.on_player_level_set(playerid, int(playerlevel))
 
     # ----------------------------------------------
@@ -635,9 +1961,14 @@ class Game:
         playerid = match_obj.group(1)
         playerelo = float(match_obj.group(2))
 
-        self.players[playerid].set_elo(playerelo)
+        if playerid not in self.players:
+            self.log.warning('player id %s not found', playerid)
+            return None
+
+        self.update_player(self.players[playerid], lambda p: p.set_elo(playerelo))
 
         if not self.infoRun:
+            self.journal_event('elo', player=playerid, elo=playerelo)
             self.on_player_elo_set(playerid, playerelo)
 
     # ----------------------------------------------
@@ -645,15 +1976,16 @@ class Game:
         playerid = match_obj.group(1)
 
         if playerid in self.players:            
-            self.known_players[playerid] = self.players[playerid]
-            self.known_players[playerid].disconnects.append(time.time())
-            print(f"removing player {playerid}")
-            del self.players[playerid]
+            self.log.info('removing player %s', playerid)
+            self.stats.remove(self.players[playerid])
+            self.roster.remove(playerid)
 
             if not self.infoRun:
+                self.reputation.record_disconnect(playerid)
+                self.journal_event('disconnect', player=playerid)
                 self.on_player_disconnect(playerid)
         else:
-            print(f'WARNING: {playerid} not found')
+            self.log.warning('player id %s not found', playerid)
 
 
     # ----------------------------------------------
@@ -662,12 +1994,13 @@ class Game:
         side = Side.Redfor if match_obj.group(2) == '1' else Side.Bluefor
 
         if playerid in self.players:
-            self.players[playerid].set_side(side)
+            self.update_player(self.players[playerid], lambda p: p.set_side(side))
 
             if not self.infoRun:
+                self.journal_event('side', player=playerid, side=int(side))
                 self.on_player_side_change(playerid, side)
         else:
-            print(f'WARNING: {playerid} not found')
+            self.log.warning('player id %s not found', playerid)
                 
 
     # ----------------------------------------------
@@ -675,9 +2008,16 @@ class Game:
 
         playerid = match_obj.group(1)
         playername = match_obj.group(2)
+
+        if playerid not in self.players:
+            self.log.warning('player id %s not found', playerid)
+            return None
+
         self.players[playerid].set_name(playername)
 
         if not self.infoRun:
+            self.reputation.record_seen(playerid, self.players[playerid].get_name())
+            self.journal_event('name', player=playerid, name=playername)
             self.on_player_name_change(playerid, playername)
 
     # ----------------------------------------------
@@ -685,6 +2025,7 @@ class Game:
         self.gameState = GameState.Game
 
         if not self.infoRun:
+            self.journal_event('phase', state=self.gameState.name)
             self.on_switch_to_game()
 
     # ----------------------------------------------
@@ -692,6 +2033,7 @@ class Game:
         self.gameState = GameState.Debriefing
 
         if not self.infoRun:
+            self.journal_event('phase', state=self.gameState.name)
             self.on_switch_to_debriefing()
 
     # ----------------------------------------------
@@ -699,6 +2041,7 @@ class Game:
         self.gameState = GameState.Lobby
 
         if not self.infoRun:
+            self.journal_event('phase', state=self.gameState.name)
             self.on_switch_to_lobby()
 
     # ----------------------------------------------
@@ -706,155 +2049,208 @@ class Game:
         self.gameState = GameState.Deployment
 
         if not self.infoRun:
+            self.journal_event('phase', state=self.gameState.name)
             self.on_switch_to_deployment()
 
     # ----------------------------------------------
     def _on_set_min_players(self, match_obj: Match[str]) -> None:
         min_players = match_obj.group(1)
         self.minPlayersToStart = int(min_players)
-        print(f'min players is {self.minPlayersToStart}')
+        self.log.info('min players is %d', self.minPlayersToStart)
 
         if not self.infoRun:
-            pass
+            self.journal_event('min_players', value=self.minPlayersToStart)
+
+    # ----------------------------------------------
+    def _on_map_change(self, match_obj: Match[str]) -> None:
+        self.currentMap = match_obj.group(1)
+        if self.currentMap in self.config.map_pool:
+            self.currentMapId = self.config.map_pool.index(self.currentMap)
+        else:
+            self.currentMapId = -1
+
+        if not self.infoRun:
+            self.journal_event('map', map=self.currentMap)
             
     # ---------------------------------------------
     # Event handlers registration
     # ---------------------------------------------
 
     def register_events(self) -> None:
-        self.register_event(r'Client added in session \(EugNetId : ([0-9]+).+IP : ([0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}):([0-9]+)', self._on_player_connect)
-        self.register_event('Client ([0-9]+) variable PlayerDeckContent set to "(.*)"', self._on_player_deck_set)
-        self.register_event('Client ([0-9]+) variable PlayerLevel set to "(.*)"', self._on_player_level_set)
-        self.register_event('Client ([0-9]+) variable PlayerElo set to "(.*)"', self._on_player_elo_set)
-        self.register_event('Client ([0-9]+) variable PlayerAlliance set to "([0-9])"', self._on_player_side_change)
-        self.register_event('Client ([0-9]+) variable PlayerName set to "(.*)"', self._on_player_name_change)
-        self.register_event('Disconnecting client ([0-9]+)', self._on_player_disconnect)
-        self.register_event('Entering in loading phase state', self._on_switch_to_game)
-        self.register_event('Entering in deploiement phase state', self._on_switch_to_deployment)
-        self.register_event('Entering in debriephing phase state', self._on_switch_to_debriefing)
-        self.register_event('Entering in matchmaking state', self._on_switch_to_lobby)
-        self.register_event('Variable NbMinPlayer set to "(.*)"', self._on_set_min_players)
+        handlers: Dict[str, Callable[[Match[str]], None]] = {
+            'connect': self._on_player_connect,
+            'deck': self._on_player_deck_set,
+            'level': self._on_player_level_set,
+            'elo': self._on_player_elo_set,
+            'side': self._on_player_side_change,
+            'name': self._on_player_name_change,
+            'disconnect': self._on_player_disconnect,
+            'game': self._on_switch_to_game,
+            'deployment': self._on_switch_to_deployment,
+            'debriefing': self._on_switch_to_debriefing,
+            'lobby': self._on_switch_to_lobby,
+            'min_players': self._on_set_min_players,
+            'map': self._on_map_change,
+        }
+        for name, regex in EVENT_PATTERNS:
+            self.event_names[self.register_event(regex, handlers[name])] = name
+        self.event_handlers.update(handlers)
+        self.event_table.extend(self.events.items())
+        self.line_filter = LineFilter([pattern.pattern for pattern in self.events])
+
+    def register_command(self, names: Iterable[str], command: ChatCommand) -> None:
+        """Register a chat command under each of `names`"""
+        for name in names:
+            self.command_table[name] = command
+        if command.rate is not None:
+            self.command_buckets[command] = TokenBucket(command.rate, command.burst)
+
+    def register_commands(self) -> None:
+        self.register_command(['rules'], ChatCommand(lambda player, msg: self.handle_rules_request(player)))
+        self.register_command(['stats'], ChatCommand(lambda player, msg: self.respond('stats', self.get_avg_team_msg, lobby_only=True)))
+        self.register_command(['commands', 'command', 'cmd', 'comand', 'comands', "'commands'", '"commands"'],
+                              ChatCommand(lambda player, msg: self.respond('commands', lambda: COMMANDS_LIST)))
+        self.register_command(['balance'], ChatCommand(lambda player, msg: self.handle_balance_request(player),
+                                                       rate=1 / BALANCE_COMMAND_INTERVAL))
+        self.register_command(['wherefrom'], ChatCommand(lambda player, msg: self.handle_wherefrom_request(player),
+                                                         rate=1 / WHEREFROM_COMMAND_INTERVAL))
+        self.register_command(['team'], ChatCommand(lambda player, msg: self.handle_team_affiliation(msg, player), takes_argument=True))
+        self.register_command(['rotate'], ChatCommand(lambda player, msg: self.handle_rotate_request(player),
+                                                    rate=VOTE_COMMANDS_PER_SECOND, burst=VOTE_COMMAND_BURST))
+        self.register_command(['kick'], ChatCommand(lambda player, msg: self.handle_kick_request(msg, player), takes_argument=True,
+                                                    rate=VOTE_COMMANDS_PER_SECOND, burst=VOTE_COMMAND_BURST))
+        self.register_command(['year'], ChatCommand(lambda player, msg: self.handle_year_request(msg, player), takes_argument=True,
+                                                    rate=VOTE_COMMANDS_PER_SECOND, burst=VOTE_COMMAND_BURST))
+        self.register_command(['income'], ChatCommand(lambda player, msg: self.handle_income_request(msg, player), takes_argument=True,
+                                                    rate=VOTE_COMMANDS_PER_SECOND, burst=VOTE_COMMAND_BURST))
 
     # -------------------------------------------
     # Utility functions
     # -------------------------------------------
 
-    def __init__(self) -> None:
+    def __init__(self, config: ServerConfig, rcon_pool: Optional[RconPool]=None, journal: Optional[Journal]=None,
+                 reputation: Optional[ReputationStore]=None, scheduler: Optional[Scheduler]=None) -> None:
+        self.config = config # base_config with the policy applied
+        self.base_config = config
+        self.policy = Policy()
+        self.log = log.getChild(config.name)
+        self.watchdog = LagWatchdog(self.log)
+        self.state_version = 0 # bumped by every log event, for cached command answers
+        self.responses = ResponseCache()
+        self.watchdog.on_change = lambda degraded: self.journal_event('degraded', degraded=degraded)
+        self.journal = journal
+        self.reputation = reputation or ReputationStore()
+        self.scheduler = scheduler
+        rcon = Rcon(config.rcon_host, config.rcon_port, config.rcon_password, rcon_pool, journal, config.name)
+        self.server = Server(config.name, rcon, config.banned_clients_path, journal)
+        self.server.scheduler = scheduler
+        self.log_offset = 0 # byte offset of the first unprocessed line in the server log
+        self.chatfile: Optional[IO[bytes]] = None
+        self.chat_pending = b'' # start of a chat line that is not complete yet
+        self.message_host = None
         self.last_message: Optional[str] = None
-        self.badwords: Dict[str, bool] = {}
+        self.last_message_version = -1 # stats version when last_message was computed
+        self.stats = LobbyStats()
+        self.avg_team_msg = ''
+        self.avg_team_msg_version = -1
         self.events: Dict[Pattern[str], Callable[[Match[str]], None]] = {}
-        self.players: Dict[str, Player] = {}
-        self.known_players: Dict[str, Player] = {}
+        self.event_names: Dict[Pattern[str], str] = {}
+        self.event_handlers: Dict[str, Callable[[Match[str]], None]] = {}
+        self.event_table: List[Tuple[Pattern[str], Callable[[Match[str]], None]]] = [] # events, by LineFilter index
+        self.line_filter = LineFilter([])
+        self.command_table: Dict[str, ChatCommand] = {} # by name and built-in alias
+        self.commands: Dict[str, ChatCommand] = {} # command_table plus the policy's aliases
+        self.command_buckets: Dict[ChatCommand, TokenBucket] = {}
+        self.roster = Roster()
         self.gameState: GameState = GameState.Lobby
         self.minPlayersToStart: int = 0
         self.infoRun: bool = True
         self.register_events()
+        self.register_commands()
         self.currentMapId = -1
-        self.tick_count = 0
-
-    def load_badwords_if_present(self) -> None:
-        if os.path.exists(BADWORDS_PATH):
-            with open(BADWORDS_PATH) as badf:
-                for line in badf.readlines():
-                    line = line.replace('*', '').strip().lower()
-                    if len(line):
-                        self.badwords[line] = True
-                print(f'loaded {len(self.badwords)} badwords from: {BADWORDS_PATH}')
-        else:
-            print(f'no badwords found at: {BADWORDS_PATH}')
-
-    def main(self) -> None:
-        print("Server control script started")
-        print("Gather information run")
-
-        self.load_badwords_if_present()
-
-        while self.infoRun:
-            # spin until serverlog is processed
-            pass 
-        print(f"Gather information run is complete: {self.lines_processed} lines processed")
-
-        print('Server control started, type "help" for help')
-        first_run = True
-        while True:
-            self.run_cli(first_run)
-            first_run = False
-            #self.dump_state()
-            self.message_average_team_info()
-            if self.tick_count % 60 == 0:
-                self.send_message("chat 'commands' for a list of commands")
-            self.tick_count += 1
-
-
-    def run_cli(self, first_run: bool) -> None:
-        if first_run:
-            print('>> ', end='', flush=True)
-        help_msg = '''
-Server.change_income_rate(2)
-Server.change_map('map_name')
-Server.change_name('name')
-Server.change_min_players_to_start(20)
-Server.change_time_limit(1500)
-Server.change_max_players(10)
-Server.change_money(1000)
-Server.change_score_limit(5000)
-Server.change_victory_cond(1)
-Server.kick_player_by_id('000000')
-Server.ban_player_by_id('000000')
-Server.send_message('CCCCCCCCCCCCCCCCCCCCCCCC', NON_EXISTENT_CLIENT_ID) (0x43 stream)
-dump
-game.map_random_rotate()
-'''
-        CLI_TIMEOUT = 100 # seconds
-        i, o, e = select.select( [sys.stdin], [], [], CLI_TIMEOUT)
-        if (i):
-            user_input = sys.stdin.readline().strip()
-            if user_input == 'help':
-                print(help_msg)
-            elif user_input == 'dump':
-                self.dump_state()
-            elif user_input.startswith('swap '):
-                target = user_input.split(' ')[1]
-                self.players[target].swap_side()
-            elif user_input.startswith('deck'):
-                target = user_input.split(' ')[1]
-                deck = user_input.split(' ')[2]
-                self.players[target].change_deck(deck)
+        self.currentMap = None
+        self.balance_suggestion: Dict[str, Side] = {} # from the last balance run
+        self.apply_policy(self.policy)
+
+    def apply_policy(self, policy: Policy) -> None:
+        """Switch to new lobby rules. Each piece is swapped in whole, so handlers on other threads see the old or the new"""
+        commands = dict(self.command_table)
+        for alias, name in policy.command_aliases:
+            if name in self.command_table:
+                commands[alias] = self.command_table[name]
             else:
-                print("COMMAND: ", user_input)
-                try:
-                    exec(user_input)
-                except Exception as e:
-                    print('command failed: ' + str(e))
-
-    def average_player_level(self, players: Iterable[Player], side: Side) -> float:
-        lvls = [player.get_level() for player in players if player.get_side() == side]
-        if len(lvls) == 0:
-            return 0
-        return mean(lvls)
+                self.log.warning('policy alias %s is for unknown command %s', alias, name)
+        self.policy = policy
+        self.config = policy.server_config(self.base_config)
+        self.commands = commands
+        self.state_version += 1 # rules and answers may have changed
+
+    @property
+    def players(self) -> Mapping[str, Player]:
+        """The current roster. Read only, so it can't change while the caller iterates it"""
+        return self.roster.current
+
+    def schedule_periodic_tasks(self) -> None:
+        """Periodic lobby messages, started once the log has been caught up with"""
+        if not self.scheduler:
+            return
+        self.scheduler.call_every(STATS_BROADCAST_INTERVAL, self.message_average_team_info)
+        self.scheduler.call_every(COMMANDS_REMINDER_INTERVAL, self.send_commands_reminder, first_delay=0)
+
+    def send_commands_reminder(self) -> None:
+        self.send_message("chat 'commands' for a list of commands")
+
+    def run_command(self, user_input: str) -> None:
+        """Execute a single admin console command against this server"""
+        if user_input == 'dump':
+            self.dump_state()
+        elif user_input.startswith('swap '):
+            target = user_input.split(' ')[1]
+            self.players[target].swap_side()
+        elif user_input.startswith('deck'):
+            target = user_input.split(' ')[1]
+            deck = user_input.split(' ')[2]
+            self.players[target].change_deck(deck)
+        else:
+            self.log.info('COMMAND: %s', user_input)
+            try:
+                exec(user_input, globals(), {'game': self, 'server': self.server})
+            except Exception as e:
+                self.log.error('command failed: %s', e)
 
     def get_avg_team_msg(self) -> str:
-        blue = 'average blue: {:.2f}'.format(self.average_player_level(self.players.values(), Side.Bluefor))
-        red = 'average red: {:.2f}'.format(self.average_player_level(self.players.values(), Side.Redfor))
-        msg = blue + " - " + red
-        return msg
+        version = self.stats.version
+        if self.avg_team_msg_version != version:
+            blue = 'average blue: {:.2f}'.format(self.stats.level.mean(Side.Bluefor))
+            red = 'average red: {:.2f}'.format(self.stats.level.mean(Side.Redfor))
+            self.avg_team_msg = blue + " - " + red
+            self.avg_team_msg_version = version
+        return self.avg_team_msg
     
     def message_average_team_info(self, force: bool=False) -> None:
+        if self.stats.version == self.last_message_version and not force:
+            return
+        if self.watchdog.degraded:
+            return # the numbers are likely stale, and will be sent once caught up
         msg = self.get_avg_team_msg()
         if msg != self.last_message or force:
-            self.send_message(msg, lobby_only=True)
+            self.send_message(msg, lobby_only=True, coalesce_key='stats')
         self.last_message = msg
+        self.last_message_version = self.stats.version
 
-    def balance(self, execute: bool=False, quiet: bool=False) -> None:
-        players = copy.deepcopy(self.players)
+    def balance(self, execute: bool=False, quiet: bool=False) -> Optional[str]:
+        """Find the most even teams, and apply them or suggest them. Returns the suggestion message, if any"""
+        message: Optional[str] = None
+        players = self.players # a snapshot, later connects and disconnects don't change it
         num_players = len(players)
         by_level: Tuple[Tuple[int, str, Optional[str], int], ...] = tuple((player.get_level(), player.get_id(), player.team_affiliation, int(player.get_side())) for player in players.values())
         suggestion_raw = balance_internal(by_level)
         if suggestion_raw is None:
-            print('could not generate balance suggestion!')
+            self.log.warning('could not generate balance suggestion!')
         else:
             playerids = [x[1] for x in by_level]
             suggestion = [(playerid, Side.Bluefor) if side == 0 else (playerid, Side.Redfor) for (side, playerid) in zip(suggestion_raw, playerids)]
+            self.balance_suggestion = dict(suggestion)
             suggest_text = 'swap '
             had_suggestion = False
             for playerid, side in suggestion:
@@ -872,40 +2268,234 @@ game.map_random_rotate()
             else:
                 if had_suggestion:
                     if len(blues) and len(reds):
-                        if not quiet: self.send_message(f'suggestion: {suggest_text}new stats: blue avg: {int(mean(blues))}, red avg: {int(mean(reds))}', lobby_only=True)
+                        message = f'suggestion: {suggest_text}new stats: blue avg: {int(mean(blues))}, red avg: {int(mean(reds))}'
                 else:
-                    if not quiet: self.send_message(f"{2**(num_players)} possibilities tried, can't do any better than what we have right now: {self.get_avg_team_msg()}", lobby_only=True)
+                    message = f"{2**(num_players)} possibilities tried, can't do any better than what we have right now: {self.get_avg_team_msg()}"
+        if message and not quiet:
+            self.send_message(message, lobby_only=True)
+        return message
         
     def dump_state(self) -> None:
         #print(chr(27) + "[2J")
         
         print("We have {} players:".format(len(self.players)))
         for player in sorted(self.players.values(), key=lambda x: str(x.get_side())):
-            print('[{}] {}:\t{}\t{}\t\tdeck-type:{}'.format(str(player.get_side()), str(player.get_level()), player.get_id(), player.get_name(), Deck.get_deck_type(player.get_deck())))
+            print('[{}] {}:\t{}\t{}\t\tdeck-type:{}'.format(str(player.get_side()), str(player.get_level()), player.get_id(), player.get_name(), player.get_deck_type()))
         print('-------------')
-        print('avg blue: {:.2f}'.format(self.average_player_level(self.players.values(), Side.Bluefor)))
-        print('avg red: {:.2f}'.format(self.average_player_level(self.players.values(), Side.Redfor)))
+        for side in Side:
+            print('{}: {} players, avg level: {:.2f}, avg elo: {:.2f}, deck types: {}'.format(
+                side.name, self.stats.team_size(side), self.stats.level.mean(side), self.stats.elo.mean(side), dict(self.stats.decks.counts[side])))
         print('-------------')
 
-    def register_event(self, regex: str, handler: Callable[[Match[str]], None]) -> None:
+    def state_snapshot(self) -> Dict[str, Any]:
+        """The lobby as plain data, for the state socket"""
+        players = list(self.players.values())
+        votes: Dict[str, Dict[str, int]] = {}
+        for player in players:
+            for category, values in list(player.votes.items()):
+                tally = votes.setdefault(category, {})
+                for value in list(values):
+                    tally[str(value)] = tally.get(str(value), 0) + 1
+        return {
+            'state': self.gameState.name,
+            'map': self.currentMap,
+            'min_players': self.minPlayersToStart,
+            'degraded': self.watchdog.is_degraded,
+            'players': [{
+                'id': player.get_id(),
+                'name': player.get_name(),
+                'level': player.get_level(),
+                'elo': player.get_elo(),
+                'side': player.get_side().name,
+                'deck': player.get_deck(),
+                'deck_type': player.get_deck_type(),
+            } for player in players],
+            'votes': votes,
+            'balance': {playerid: side.name for playerid, side in self.balance_suggestion.items() if playerid in self.players},
+        }
+
+    def journal_event(self, event: str, **fields: Any) -> None:
+        if self.journal:
+            self.journal.record(self.config.name, event, fields)
+
+    def handle_event(self, handler: Callable[[Match[str]], None], match: Match[str]) -> None:
+        try:
+            handler(match)
+        except Exception:
+            # one bad line must not cost the rest of the block, or stop the log thread
+            self.log.exception('error in %s', getattr(handler, '__name__', handler))
+        self.state_version += 1
+
+    def register_event(self, regex: str, handler: Callable[[Match[str]], None]) -> Pattern[str]:
         """Register event handler for a certain log entry"""
-        self.events[re.compile(regex)] = handler
+        pattern = re.compile(regex)
+        self.events[pattern] = handler
+        return pattern
 
     def update(self) -> int:
-        """Parse log and trigger event handler"""
-        counter = 0
-        for line_i, line in enumerate(open(SERVER_LOG_PATH).readlines()):
-            counter += 1
-            if counter < self.lines_processed + 1:
-                continue
-            # Test against event expressions
-            #print(f"DEBUG {line}", {self.lines_processed}, {counter})
-            for pair in self.events.items():
-                match = pair[0].match(line)
-                if match:
-                    pair[1](match)
+        """Parse the lines appended to the log since the last call and trigger event handlers"""
+        with open(self.config.log_path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < self.log_offset:
+                # the server restarted: whoever was connected is gone without a disconnect line
+                self.log.warning('%s was truncated, reading from the start', self.config.log_path)
+                self.reset_state()
+            counter = self.lines_processed
+            if size == self.log_offset:
+                if not self.infoRun:
+                    self.watchdog.end_batch(0) # nothing left to read, so whatever slowed us down is over
+                return counter
+            f.seek(self.log_offset)
+            if not self.infoRun:
+                self.watchdog.start_batch(size - self.log_offset)
+            # only consume complete lines, the server may be in the middle of writing the last one
+            for data, end in read_blocks(f):
+                self.log_offset += end
+                counter += self.dispatch_lines(data, end)
+        if not self.infoRun:
+            self.watchdog.end_batch(os.path.getsize(self.config.log_path) - self.log_offset)
         return counter
 
+    def dispatch_lines(self, data: bytes, end: int) -> int:
+        """
+        Trigger the event handlers for the lines in data[:end]. Only lines
+        starting like some event are decoded, and invalid UTF-8 (say, in a
+        player name) is replaced rather than raised. Returns the line count
+        """
+        for line, candidates in self.line_filter.lines(data, end):
+            text = line.decode('utf-8', 'replace')
+            for index in candidates:
+                pattern, handler = self.event_table[index]
+                match = pattern.match(text)
+                if match:
+                    self.handle_event(handler, match)
+        return data.count(b'\n', 0, end)
+
+    def reset_state(self) -> None:
+        """Forget everything learned from the log"""
+        self.state_version += 1
+        self.roster = Roster()
+        self.stats = LobbyStats()
+        # the new stats count versions from 0 again, so forget what was cached against the old ones
+        self.avg_team_msg_version = -1
+        self.last_message = None
+        self.last_message_version = -1
+        self.balance_suggestion = {}
+        self.message_host = None
+        self.gameState = GameState.Lobby
+        self.minPlayersToStart = 0
+        self.currentMapId = -1
+        self.currentMap = None
+        self.log_offset = 0
+        self.lines_processed = 0
+
+    def restore_from_tail(self) -> bool:
+        """
+        Rebuild the lobby from the end of the log instead of replaying all of it:
+        find the last "Entering in matchmaking state" and replay only the lines
+        after it, plus the most recent value of each server setting, and the
+        connect line and latest name, level, elo, side and deck of every player
+        still connected from before it. Returns False (with the state reset) if
+        there is no such line, or if the window mentions players it never saw
+        connect, so the caller can fall back to a forward scan.
+        """
+        with open(self.config.log_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return False
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                end = mm.rfind(b'\n') + 1
+                lobby = mm.rfind(literal_prefix(dict(EVENT_PATTERNS)['lobby']), 0, end)
+                if lobby < 0:
+                    return False
+                start = mm.rfind(b'\n', 0, lobby) + 1
+                lines = []
+                for name in SETTING_EVENTS:
+                    prefix = literal_prefix(dict(EVENT_PATTERNS)[name])
+                    pos = mm.rfind(prefix, 0, start)
+                    if pos >= 0:
+                        line_start = mm.rfind(b'\n', 0, pos) + 1
+                        lines.append(mm[line_start:mm.find(b'\n', pos)])
+                lines += self.connected_before(mm, start)
+                window = mm[start:end]
+
+        data = b''.join(line + b'\n' for line in lines) + window
+        for line, candidates in self.line_filter.lines(data, len(data)):
+            text = line.decode('utf-8', 'replace')
+            for index in candidates:
+                regex, handler = self.event_table[index]
+                match = regex.match(text)
+                if not match:
+                    continue
+                if self.event_names[regex] in PLAYER_EVENTS and match.group(1) not in self.players:
+                    self.log.info('player %s was connected before the last lobby, falling back to reading the whole log',
+                                  match.group(1))
+                    self.reset_state()
+                    return False
+                self.handle_event(handler, match)
+        self.log_offset = end
+        self.lines_processed = data.count(b'\n')
+        self.log.info('restored the lobby from the last %d bytes of the log', end - start)
+        return True
+
+    def connected_before(self, mm: mmap.mmap, start: int) -> List[bytes]:
+        """
+        Walk the log backwards from `start` and return the lines that rebuild
+        the players still connected there: for each, its last connect line and
+        the most recent line of each player event since. Only lines passing the
+        byte prefix filter are decoded, and no handlers run.
+        """
+        status: Dict[str, bool] = {} # whether the player's last connect or disconnect was a connect
+        latest: Dict[str, Dict[str, bytes]] = {} # player -> event name -> most recent line
+        live: List[str] = []
+        chunk_end = start
+        while chunk_end > 0:
+            chunk_start = mm.rfind(b'\n', 0, chunk_end - LOG_READ_BYTES) + 1 if chunk_end > LOG_READ_BYTES else 0
+            data = mm[chunk_start:chunk_end]
+            for line, candidates in reversed(list(self.line_filter.lines(data, len(data)))):
+                text = line.decode('utf-8', 'replace')
+                for index in candidates:
+                    regex = self.event_table[index][0]
+                    name = self.event_names[regex]
+                    if name != 'connect' and name not in PLAYER_EVENTS:
+                        continue
+                    match = regex.match(text)
+                    if not match:
+                        continue
+                    playerid = match.group(1)
+                    if playerid in status:
+                        continue # an older session, or this player is gone
+                    if name == 'connect':
+                        status[playerid] = True
+                        latest.setdefault(playerid, {})['connect'] = line
+                        live.append(playerid)
+                    elif name == 'disconnect':
+                        status[playerid] = False
+                    else:
+                        latest.setdefault(playerid, {}).setdefault(name, line)
+            chunk_end = chunk_start
+        # oldest connect first, so the roster keeps its order
+        return [line for playerid in reversed(live) for name, line in sorted(latest[playerid].items(), key=lambda item: item[0] != 'connect')]
+
+    def read_chat(self) -> bool:
+        """Dispatch the lines appended to the chat log since the last call. Returns whether anything was read"""
+        if self.chatfile is None:
+            if not os.path.exists(self.config.chat_path):
+                return False
+            self.chatfile = open(self.config.chat_path, 'rb')
+            # read to the end of the file
+            self.chatfile.seek(0, 2) # seek to end of file
+        block = self.chatfile.read(LOG_READ_BYTES)
+        if not block:
+            return False
+        data = self.chat_pending + block
+        end = data.rfind(b'\n') + 1
+        self.chat_pending = data[end:] # the rest of a line being written
+        for matched in CHAT_LINE_FILTER.finditer(data, 0, end):
+            clientid = matched.group(1).decode('ascii')
+            msg = matched.group(2).rstrip(b'\r').decode('utf-8', 'replace')
+            self.on_player_message(clientid, msg)
+        return True
+
 
 
 def balance_internal(by_level: Tuple[Tuple[int, str, Optional[str], int], ...]) -> Optional[Tuple[int, ...]]:
@@ -980,7 +2570,7 @@ def balance_internal(by_level: Tuple[Tuple[int, str, Optional[str], int], ...])
             if best is None or score < best:
                 best = score
                 best_set = combination
-    print(f'best set: {best_set} with score: {best} (original: {original_score})')
+    log.debug('best set: %s with score: %s (original: %s)', best_set, best, original_score)
     return best_set
 
 def test_balance() -> None: 
@@ -1055,35 +2645,50 @@ class PyRconException(Exception):
 
 
 class PyRcon(object):
-    socket = None
 
-    def connect(self, host: str, port: str, password: str):
+    def __init__(self, timeout: Optional[float]=None) -> None:
+        self.socket: Optional[socket.socket] = None
+        self.timeout = timeout # for connecting and the whole exchange after it
+        self.deadline: Optional[float] = None
+
+    def connect(self, host: str, port: str, password: str) -> None:
         if self.socket is not None:
             raise PyRconException("Already connected")
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.connect((host, int(port)))
+        if self.timeout is not None:
+            self.deadline = time.monotonic() + self.timeout
+        self.socket = socket.create_connection((host, int(port)), self.timeout)
         self.send(3, password)
 
-    def disconnect(self):
+    def disconnect(self) -> None:
         if self.socket is None:
             raise PyRconException("Already disconnected")
         self.socket.close()
         self.socket = None
 
-    def read(self, length: int):
+    def read(self, length: int) -> bytes:
+        if self.socket is None:
+            raise PyRconException("Must connect before reading data")
         data = b""
         while len(data) < length:
-            data += self.socket.recv(length - len(data))
+            if self.deadline is not None:
+                remaining = self.deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PyRconException("Timed out")
+                self.socket.settimeout(remaining)
+            chunk = self.socket.recv(length - len(data))
+            if not chunk:
+                raise PyRconException("Connection closed")
+            data += chunk
         return data
 
-    def send(self, out_type: int, out_data: str):
+    def send(self, out_type: int, out_data: str) -> str:
         if self.socket is None:
             raise PyRconException("Must connect before sending data")
 
         # Send a request packet
         out_payload = struct.pack('<ii', 0, out_type) + out_data.encode('utf8') + b'\x00\x00'
         out_length = struct.pack('<i', len(out_payload))
-        self.socket.send(out_length + out_payload)
+        self.socket.sendall(out_length + out_payload)
 
         # Read response packets
         in_data = ""
@@ -1107,7 +2712,7 @@ class PyRcon(object):
             if len(select.select([self.socket], [], [], 0)[0]) == 0:
                 return in_data
 
-    def command(self, command: str):
+    def command(self, command: str) -> str:
         result = self.send(2, command)
         time.sleep(0.003)
         return result 
@@ -1117,31 +2722,443 @@ class PyRcon(object):
 #test_balance()
 #sys.exit(0)
 
-# globals
-game: Game = Game()
+class RingBuffer:
+    """
+    Single producer, single consumer byte ring in shared memory, used to pass
+    parsed log events between processes. The header holds the total number of
+    bytes ever written and read, each only updated by its own side, with
+    native aligned stores. Records are a 2 byte length and a payload, and may
+    wrap around the end of the buffer.
+    """
+    HEADER = struct.Struct('QQ') # written, read
+    LENGTH = struct.Struct('H')
+
+    def __init__(self, shm: Any) -> None:
+        self.shm = shm
+        self.buf = shm.buf
+        self.capacity = len(self.buf) - self.HEADER.size
+
+    def put(self, payload: bytes) -> bool:
+        """Append a record. Returns False if there isn't room for it yet"""
+        written, read = self.HEADER.unpack_from(self.buf, 0)
+        record = self.LENGTH.pack(len(payload)) + payload
+        if self.capacity - (written - read) < len(record):
+            return False
+        self.copy_in(written, record)
+        # publish the record only once its bytes are in place
+        struct.pack_into('Q', self.buf, 0, written + len(record))
+        return True
+
+    def pending(self) -> int:
+        """Bytes written but not read yet"""
+        written, read = self.HEADER.unpack_from(self.buf, 0)
+        return cast(int, written - read)
+
+    def get_all(self) -> List[bytes]:
+        """Take every complete record written so far"""
+        written, read = self.HEADER.unpack_from(self.buf, 0)
+        if written == read:
+            return []
+        data = self.copy_out(read, written - read)
+        records = []
+        pos = 0
+        while pos < len(data):
+            (length,) = self.LENGTH.unpack_from(data, pos)
+            pos += self.LENGTH.size
+            records.append(data[pos:pos + length])
+            pos += length
+        struct.pack_into('Q', self.buf, 8, written)
+        return records
+
+    def copy_in(self, position: int, data: bytes) -> None:
+        start = position % self.capacity
+        first = min(len(data), self.capacity - start)
+        base = self.HEADER.size
+        self.buf[base + start:base + start + first] = data[:first]
+        self.buf[base:base + len(data) - first] = data[first:]
+
+    def copy_out(self, position: int, length: int) -> bytes:
+        start = position % self.capacity
+        first = min(length, self.capacity - start)
+        base = self.HEADER.size
+        return bytes(self.buf[base + start:base + start + first]) + bytes(self.buf[base:base + length - first])
+
+
+# event ids in ingest records, after the indexes into EVENT_PATTERNS
+CHAT_EVENT = len(EVENT_PATTERNS)
+CAUGHT_UP_EVENT = 255 # the worker has read the whole log once; the value is the number of lines
+TRUNCATED_EVENT = 254 # the server log was truncated and is read again from the start
+
+class ParsedMatch:
+    """Stands in for the regex match of an event that was parsed by the ingest process"""
+
+    def __init__(self, values: List[str]) -> None:
+        self.values = values
+
+    def group(self, index: int) -> str:
+        return self.values[index - 1]
+
+
+def ingest_logs(shm: Any, sources: List[Tuple[str, str]], log_offsets: List[int]) -> None:
+    """
+    Body of the ingest process: tails the server and chat log of every game,
+    matches the lines and pushes the events into the ring. Records are a game
+    index, an event id and the matched groups separated by NUL bytes. Chat is
+    only read from the end of the file, once the server log has been caught up.
+    """
+    ring = RingBuffer(shm)
+    parent = os.getppid()
+    patterns = [re.compile(regex.encode()) for _, regex in EVENT_PATTERNS]
+    line_filter = LineFilter([regex for _, regex in EVENT_PATTERNS])
+    offsets = list(log_offsets)
+    line_counts = [0] * len(sources)
+    caught_up = [False] * len(sources)
+    chatfiles: List[Optional[IO[bytes]]] = [None] * len(sources)
+    chat_pending = [b''] * len(sources)
+    dropped = 0
+
+    def push(game_index: int, event_id: int, values: Iterable[bytes]) -> None:
+        nonlocal dropped
+        payload = bytes((game_index, event_id)) + b'\0'.join(values)
+        if len(payload) > 0xffff:
+            dropped += 1 # doesn't fit the record length
+            log.warning('ingest: dropped a %d byte %s event for %s (%d dropped so far)', len(payload),
+                        EVENT_PATTERNS[event_id][0] if event_id < len(EVENT_PATTERNS) else 'chat', sources[game_index][0], dropped)
+            return
+        while not ring.put(payload):
+            time.sleep(0.01) # the controller is behind, wait for room rather than lose events
+
+    while os.getppid() == parent:
+        any_read = False
+        for index, (log_path, chat_path) in enumerate(sources):
+            try:
+                with open(log_path, 'rb') as f:
+                    if os.fstat(f.fileno()).st_size < offsets[index]:
+                        offsets[index] = 0
+                        line_counts[index] = 0
+                        push(index, TRUNCATED_EVENT, [])
+                    f.seek(offsets[index])
+                    for data, end in read_blocks(f):
+                        offsets[index] += end
+                        for line, candidates in line_filter.lines(data, end):
+                            for event_id in candidates:
+                                match = patterns[event_id].match(line)
+                                if match:
+                                    push(index, event_id, match.groups())
+                        line_counts[index] += data.count(b'\n', 0, end)
+                        any_read = True
+            except OSError as e:
+                log.warning('ingest: could not read %s: %s', log_path, e)
+
+            if not caught_up[index]:
+                caught_up[index] = True
+                push(index, CAUGHT_UP_EVENT, [str(line_counts[index]).encode()])
+            chatfile = chatfiles[index]
+            if chatfile is None:
+                if os.path.exists(chat_path):
+                    chatfile = chatfiles[index] = open(chat_path, 'rb')
+                    chatfile.seek(0, 2) # read to the end of the file
+                continue
+            data = chat_pending[index] + chatfile.read(LOG_READ_BYTES)
+            end = data.rfind(b'\n') + 1
+            chat_pending[index] = data[end:]
+            for match in CHAT_LINE_FILTER.finditer(data, 0, end):
+                push(index, CHAT_EVENT, (match.group(1), match.group(2).rstrip(b'\r')))
+            any_read = any_read or len(data) > len(chat_pending[index])
+        if not any_read:
+            time.sleep(0.1)
+
 
+class StateRequestHandler(socketserver.StreamRequestHandler):
+    """One state socket client. Reads commands, one per line, and writes snapshots"""
 
-def update_game() -> None:
-    """Global tick for the log parsing functionality"""
-    while True:
-        game.lines_processed = game.update()
-        game.infoRun = False
-        time.sleep(0.25)
-
-def parse_chat() -> None:
-    time.sleep(4) # give us a chance to parse the game log
-    chatfile: IO[str] = open(DEFAULT_CHAT_PATH, "r", encoding="utf-8")
-    # read to the end of the file
-    chatfile.seek(0, 2) # seek to end of file
-    line_regex = re.compile(r'\[\d+\] (\d+): (.+)')
-    while True:
-        time.sleep(0.1)
-        line = chatfile.readline()
-        matched = line_regex.match(line)
-        if matched:
-            clientid = matched.group(1)
-            msg = matched.group(2)
-            game.on_player_message(clientid, msg)
+    def handle(self) -> None:
+        state = cast(Any, self.server).state
+        try:
+            for raw in self.rfile:
+                words = raw.decode('utf-8', 'replace').split()
+                if not words:
+                    continue
+                if words[0] == 'get':
+                    self.wfile.write(state.current()[1])
+                elif words[0] == 'wait' and len(words) == 2 and words[1].isdigit():
+                    self.wfile.write(state.wait_for(int(words[1]), STATE_WAIT_TIMEOUT)[1])
+                elif words[0] == 'subscribe':
+                    version, snapshot = state.current()
+                    while True:
+                        self.wfile.write(snapshot)
+                        version, snapshot = state.wait_for(version, None)
+                else:
+                    self.wfile.write(b'{"error": "commands are: get, wait <version>, subscribe"}\n')
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+class StateServer:
+    """
+    Serves the live state of every game, read only, as json over a Unix socket
+    so other tools don't have to parse the server log themselves. Changes are
+    published as a versioned snapshot that is serialized once; clients only
+    ever read the current one, so they never hold up the log or chat threads.
+    Commands, one per line:
+        get             -> the current snapshot
+        wait <version>  -> the first snapshot newer than <version> (long poll)
+        subscribe       -> the current snapshot, then every new one
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.version = 0
+        self.state: Optional[Dict[str, Any]] = None
+        self.snapshot = b'{"version": 0, "servers": {}}\n'
+        self.condition = Condition()
+        if os.path.exists(path):
+            os.remove(path) # left over from a previous run
+        server = socketserver.ThreadingUnixStreamServer(path, StateRequestHandler)
+        server.daemon_threads = True
+        cast(Any, server).state = self
+        Thread(target=server.serve_forever, daemon=True).start()
+        log.info('serving lobby state on: %s', path)
+
+    def publish(self, state: Dict[str, Any]) -> None:
+        """Make `state` the current snapshot, if it differs from the last one"""
+        with self.condition:
+            if state == self.state:
+                return
+            self.state = state
+            self.version += 1
+            self.snapshot = (json.dumps({'version': self.version, 'servers': state}) + '\n').encode()
+            self.condition.notify_all()
+
+    def current(self) -> Tuple[int, bytes]:
+        with self.condition:
+            return self.version, self.snapshot
+
+    def wait_for(self, version: int, timeout: Optional[float]) -> Tuple[int, bytes]:
+        """The first snapshot newer than `version`, or the current one after `timeout` seconds"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.version > version, timeout)
+            return self.version, self.snapshot
+
+
+class Controller:
+    """
+    Drives one or more servers from a single process. All log tailing happens on
+    one thread, all chat tailing on another, and rcon commands go through a
+    small shared pool, so adding a server only adds its Game state.
+    """
+    MAX_RCON_WORKERS = 4
+
+    def __init__(self, configs: List[ServerConfig], journal_dir: Optional[str]=None, reputation_db: Optional[str]=None,
+                 fast_startup: bool=False, state_socket: Optional[str]=None, ingest_process: bool=False,
+                 policy_path: Optional[str]=None) -> None:
+        self.fast_startup = fast_startup
+        self.ingest_process = ingest_process
+        self.state_server = StateServer(state_socket) if state_socket else None
+        self.rcon_pool = RconPool(min(len(configs), self.MAX_RCON_WORKERS))
+        self.journal = Journal(journal_dir) if journal_dir else None
+        self.reputation = ReputationStore(reputation_db)
+        self.scheduler = Scheduler()
+        self.policy_path = policy_path
+        policy = load_policy(policy_path)
+        self.policy_mtimes = self.file_mtimes(policy.files)
+        self.games: List[Game] = []
+        for config in configs:
+            game = Game(config, self.rcon_pool, self.journal, self.reputation, self.scheduler)
+            game.apply_policy(policy)
+            self.games.append(game)
+        self.selected: Game = self.games[0]
+
+    @staticmethod
+    def file_mtimes(paths: Iterable[str]) -> Tuple[Optional[float], ...]:
+        return tuple(os.stat(path).st_mtime if os.path.exists(path) else None for path in paths)
+
+    def reload_policy(self) -> None:
+        """Load the policy file again and hand it to every game; a bad file leaves the current policy in place"""
+        try:
+            policy = load_policy(self.policy_path)
+        except (OSError, ValueError) as e:
+            log.error('keeping the current policy: %s', e)
+            return
+        self.policy_mtimes = self.file_mtimes(policy.files)
+        for game in self.games:
+            game.apply_policy(policy)
+
+    def check_policy(self) -> None:
+        mtimes = self.file_mtimes(self.games[0].policy.files)
+        if mtimes != self.policy_mtimes:
+            self.policy_mtimes = mtimes # don't retry a bad file until it changes again
+            self.reload_policy()
+
+    def find_game(self, name: str) -> Optional[Game]:
+        for game in self.games:
+            if game.config.name == name:
+                return game
+        return None
+
+    def publish_state(self) -> None:
+        if self.state_server:
+            self.state_server.publish({game.config.name: game.state_snapshot() for game in self.games})
+
+    def restore_games(self) -> None:
+        for game in self.games:
+            try:
+                game.restore_from_tail()
+            except OSError as e:
+                game.log.error('could not read %s: %s', game.config.log_path, e)
+
+    def update_games(self) -> None:
+        """Global tick for the log parsing functionality"""
+        if self.fast_startup:
+            self.restore_games()
+        while True:
+            for game in self.games:
+                try:
+                    game.lines_processed = game.update()
+                except OSError as e:
+                    game.log.error('could not read %s: %s', game.config.log_path, e)
+                except Exception:
+                    game.log.exception('error reading %s', game.config.log_path)
+                game.infoRun = False
+            self.publish_state()
+            time.sleep(0.25)
+
+    def parse_chats(self) -> None:
+        while True:
+            any_read = False
+            for game in self.games:
+                if game.infoRun:
+                    continue # give us a chance to parse the game log
+                try:
+                    any_read = game.read_chat() or any_read
+                except Exception:
+                    game.log.exception('error reading %s', game.config.chat_path)
+            if any_read:
+                self.publish_state() # votes may have changed
+            else:
+                time.sleep(0.1)
+
+    def consume_events(self) -> None:
+        """
+        With --ingest_process: the log and chat tailing happen in another
+        process, so that matching lines doesn't compete with balance runs
+        and handlers for the GIL. This thread only dispatches its events.
+        """
+        if self.fast_startup:
+            self.restore_games()
+        shm = shared_memory.SharedMemory(create=True, size=RingBuffer.HEADER.size + INGEST_RING_BYTES)
+        ring = RingBuffer(shm)
+        ring.buf[:RingBuffer.HEADER.size] = bytes(RingBuffer.HEADER.size)
+        sources = [(game.config.log_path, game.config.chat_path) for game in self.games]
+        # spawn rather than fork: this process already has threads that may hold locks
+        multiprocessing.get_context('spawn').Process(target=ingest_logs, args=(shm, sources, [game.log_offset for game in self.games]), daemon=True).start()
+        try:
+            while True:
+                records = ring.get_all()
+                if not records:
+                    time.sleep(0.01)
+                    continue
+                backlog = ring.pending() + sum(len(record) for record in records)
+                for game in self.games:
+                    if not game.infoRun:
+                        game.watchdog.start_batch(backlog)
+                for record in records:
+                    game = self.games[record[0]]
+                    event_id = record[1]
+                    values = record[2:].decode('utf-8', 'replace').split('\0')
+                    try:
+                        if event_id == CAUGHT_UP_EVENT:
+                            game.lines_processed += int(values[0])
+                            game.infoRun = False
+                        elif event_id == TRUNCATED_EVENT:
+                            game.log.warning('%s was truncated, reading from the start', game.config.log_path)
+                            game.reset_state()
+                        elif event_id == CHAT_EVENT:
+                            game.on_player_message(values[0], values[1])
+                        else:
+                            game.handle_event(game.event_handlers[EVENT_PATTERNS[event_id][0]], cast(Match[str], ParsedMatch(values)))
+                    except Exception:
+                        game.log.exception('error handling ingest event %d %r', event_id, values)
+                for game in self.games:
+                    if not game.infoRun:
+                        game.watchdog.end_batch(ring.pending())
+                self.publish_state()
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def main(self) -> None:
+        log.info('Server control script started')
+        log.info('Gather information run')
+
+        if self.ingest_process:
+            Thread(target=self.consume_events).start()
+        else:
+            Thread(target=self.parse_chats).start()
+            Thread(target=self.update_games).start()
+
+        while any(game.infoRun for game in self.games):
+            # spin until serverlogs are processed
+            time.sleep(0.01)
+        for game in self.games:
+            game.log.info('Gather information run is complete: %d lines processed', game.lines_processed)
+            game.schedule_periodic_tasks()
+        self.scheduler.call_every(DISCONNECTS_IN_LAST_N_MINUTES_TO_BAN * 60, self.reputation.prune)
+        self.scheduler.call_every(POLICY_CHECK_INTERVAL, self.check_policy)
+        signal.signal(signal.SIGHUP, lambda signum, frame: Thread(target=self.reload_policy, daemon=True).start())
+
+        print('Server control started, type "help" for help')
+        first_run = True
+        while self.run_cli(first_run):
+            first_run = False
+        # no console (eg running under systemd): keep serving from the other threads
+        Event().wait()
+
+    def run_cli(self, first_run: bool) -> bool:
+        """Handle one console command. Returns False once stdin is closed"""
+        if first_run:
+            print('>> ', end='', flush=True)
+        help_msg = '''
+servers
+select <server-name>
+server.change_income_rate(2)
+server.change_map('map_name')
+server.change_name('name')
+server.change_min_players_to_start(20)
+server.change_time_limit(1500)
+server.change_max_players(10)
+server.change_money(1000)
+server.change_score_limit(5000)
+server.change_victory_cond(1)
+server.kick_player_by_id('000000')
+server.ban_player_by_id('000000')
+server.ban_player_by_id('000000', 24 * 3600)
+server.ban_network('1.2.3.0/24')
+server.bans.unban('1.2.3.0/24')
+game.unban_player('000000')
+server.send_message('CCCCCCCCCCCCCCCCCCCCCCCC', NON_EXISTENT_CLIENT_ID) (0x43 stream)
+dump
+game.map_random_rotate()
+'''
+        line = sys.stdin.readline()
+        if not line:
+            return False
+        user_input = line.strip()
+        if user_input == 'help':
+            print(help_msg)
+        elif user_input == 'servers':
+            for game in self.games:
+                print(f"{'*' if game is self.selected else ' '} {game.config.name}: {len(game.players)} players, rcon port {game.config.rcon_port}")
+        elif user_input.startswith('select '):
+            found = self.find_game(user_input.split(' ')[1])
+            if found:
+                self.selected = found
+                print(f'selected server: {found.config.name}')
+            else:
+                print('unknown server, try "servers"')
+        elif user_input:
+            self.selected.run_command(user_input)
+        return True
 
 
 def main(args: argparse.Namespace) -> None:
@@ -1149,27 +3166,41 @@ def main(args: argparse.Namespace) -> None:
         print("this script must run as root")
         sys.exit(1)
 
-    Rcon.rcon_password = args.rcon_password
-    Rcon.rcon_port = args.rcon_port
-    
-    sniff_thread = Thread(target = parse_chat)
-    sniff_thread.start()
+    if args.ingest_process and shared_memory is None:
+        print("--ingest_process needs python 3.8 or later")
+        sys.exit(1)
 
-    update_thread = Thread(target = update_game)
-    update_thread.start()
+    if args.config:
+        configs = load_server_configs(args.config)
+    else:
+        configs = [ServerConfig(rcon_port=args.rcon_port, rcon_password=args.rcon_password, chat_path=args.chat_path)]
 
-    game.main()
+    for config in configs:
+        if not os.path.exists(config.log_path):
+            log.error('could not find server log at path: %s', config.log_path)
+            sys.exit(0)
+        log.info('[%s] expecting to see server logs in: %s', config.name, config.log_path)
+        log.info('[%s] expecting to see chat logs in: %s', config.name, config.chat_path)
 
-if __name__ == "__main__":
-    if not os.path.exists(SERVER_LOG_PATH):
-        print(f'could not find server log at path: {SERVER_LOG_PATH}')
-        sys.exit(0)
+    if args.policy and not os.path.exists(args.policy):
+        log.error('could not find policy file at path: %s', args.policy)
+        sys.exit(1)
 
+    Controller(configs, args.journal_dir, args.reputation_db or None, args.fast_startup, args.state_socket, args.ingest_process, args.policy).main()
+
+if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--rcon_port", help="rcon port number", default=DEFAULT_RCON_PORT)
     parser.add_argument("--rcon_password", help="rcon password", default=DEFAULT_RCON_PASSWORD)
     parser.add_argument("--chat_path", help="path to the server chat log", default=DEFAULT_CHAT_PATH)
+    parser.add_argument("--reputation_db", help="sqlite file remembering badwords, kicks, bans and leave/join history across restarts (empty to disable)", default="reputation.sqlite")
+    parser.add_argument("--journal_dir", help="write a structured journal of every event and rcon command to this directory")
+    parser.add_argument("--fast_startup", action="store_true", help="rebuild the lobby from the end of the server log instead of reading all of it")
+    parser.add_argument("--state_socket", help="serve the live lobby state as json on this unix socket path")
+    parser.add_argument("--ingest_process", action="store_true", help="read and match the logs in a separate process (python 3.8+)")
+    parser.add_argument("--log_level", help="debug, info, warning or error", default="info")
+    parser.add_argument("--policy", help="json file with lobby rules (levels, decks, votes, maps, badwords), reloaded on change or SIGHUP")
+    parser.add_argument("--config", help="json file listing several servers to control from this process (overrides the flags above)")
     args = parser.parse_args() 
-    print('expecting to see server logs in: ' + SERVER_LOG_PATH)
-    print('expecting to see chat logs in: ' + DEFAULT_CHAT_PATH)
+    setup_logging(args.log_level)
     main(args)
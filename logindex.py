@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""
+
+    Offline indexer and query tool for archived serverlog.txt / chat.txt files
+
+    Archives are split into line-aligned chunks that are matched in parallel
+    against the same event patterns control.py uses, then replayed in order to
+    build a per-player, per-session SQLite index. Files already indexed with
+    the same size and mtime are skipped, so re-running over a growing archive
+    directory only reads the new files.
+
+    Usage:
+        ./logindex.py index --db index.sqlite archive/serverlog-*.txt --chat archive/chat-*.txt
+        ./logindex.py query --db index.sqlite leavers
+        ./logindex.py query --db index.sqlite map-levels
+        ./logindex.py query --db index.sqlite chatty
+        ./logindex.py query --db index.sqlite player 12345
+
+"""
+
+import argparse
+import mmap
+import multiprocessing
+import os
+import re
+import sqlite3
+import sys
+import time
+from typing import Any, Dict, Iterator, List, Optional, Pattern, Tuple
+
+from control import CHAT_LINE_REGEX, EVENT_PATTERNS, GameState
+
+CHUNK_BYTES = 32 * 1024 * 1024
+
+SERVER_LOG = 'server'
+CHAT_LOG = 'chat'
+
+# (kind, path, start, end)
+Chunk = Tuple[str, str, int, int]
+# (event name, decoded regex groups)
+Event = Tuple[str, Tuple[str, ...]]
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    kind TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    indexed_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS matches (
+    id INTEGER PRIMARY KEY,
+    file_id INTEGER NOT NULL,
+    map TEXT,
+    num_players INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS match_players (
+    match_id INTEGER NOT NULL,
+    player TEXT NOT NULL,
+    side INTEGER,
+    level INTEGER
+);
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    file_id INTEGER NOT NULL,
+    player TEXT NOT NULL,
+    name TEXT,
+    ip TEXT,
+    level INTEGER,
+    elo REAL,
+    side INTEGER,
+    deck TEXT,
+    map TEXT,
+    connect_state TEXT,
+    disconnect_state TEXT -- NULL if still connected at the end of the file
+);
+CREATE TABLE IF NOT EXISTS chat (
+    file_id INTEGER NOT NULL,
+    player TEXT NOT NULL,
+    message TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_player ON sessions (player);
+CREATE INDEX IF NOT EXISTS sessions_file ON sessions (file_id);
+CREATE INDEX IF NOT EXISTS matches_file ON matches (file_id);
+CREATE INDEX IF NOT EXISTS match_players_match ON match_players (match_id);
+CREATE INDEX IF NOT EXISTS chat_player ON chat (player);
+CREATE INDEX IF NOT EXISTS chat_file ON chat (file_id);
+'''
+
+IN_GAME_STATES = (GameState.Game.name, GameState.Deployment.name)
+
+#================================================================================#
+# parallel scan
+#================================================================================#
+
+def combined_pattern(patterns: List[Tuple[str, str]]) -> Tuple[Pattern[bytes], Dict[str, Tuple[str, int, int]]]:
+    """
+    Join every event regex into one multiline bytes regex, so a chunk is scanned
+    with a single finditer instead of a python loop per line. Returns the regex
+    and, for each alternative's group name, (event name, first group, group count).
+    """
+    alternatives = []
+    groups: Dict[str, Tuple[str, int, int]] = {}
+    next_group = 1
+    for i, (name, regex) in enumerate(patterns):
+        group_name = f'e{i}'
+        num_groups = re.compile(regex).groups
+        groups[group_name] = (name, next_group + 1, num_groups)
+        next_group += 1 + num_groups
+        alternatives.append(f'(?P<{group_name}>{regex})')
+    return re.compile(('^(?:' + '|'.join(alternatives) + ')').encode(), re.MULTILINE), groups
+
+SERVER_LOG_REGEX, SERVER_LOG_GROUPS = combined_pattern(EVENT_PATTERNS)
+CHAT_REGEX, CHAT_GROUPS = combined_pattern([('chat', CHAT_LINE_REGEX.pattern)])
+
+def scan_chunk(chunk: Chunk) -> List[Event]:
+    """Worker: match one chunk of a file, decoding only the groups of matching lines"""
+    kind, path, start, end = chunk
+    regex, groups = (SERVER_LOG_REGEX, SERVER_LOG_GROUPS) if kind == SERVER_LOG else (CHAT_REGEX, CHAT_GROUPS)
+    events: List[Event] = []
+    with open(path, 'rb') as f:
+        if end <= start:
+            return events
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for match in regex.finditer(mm, start, end):
+                name, first, count = groups[match.lastgroup or '']
+                values = tuple(match.group(g).decode('utf-8', errors='replace').rstrip('\r') for g in range(first, first + count))
+                events.append((name, values))
+    return events
+
+def split_file(kind: str, path: str, chunk_bytes: int=CHUNK_BYTES) -> List[Chunk]:
+    """Cut a file into chunks that start and end on line boundaries"""
+    size = os.path.getsize(path)
+    chunks: List[Chunk] = []
+    with open(path, 'rb') as f:
+        start = 0
+        while start < size:
+            end = start + chunk_bytes
+            if end >= size:
+                end = size
+            else:
+                f.seek(end)
+                f.readline()
+                end = f.tell()
+            chunks.append((kind, path, start, end))
+            start = end
+    return chunks
+
+#================================================================================#
+# sequential replay
+#================================================================================#
+
+class SessionBuilder:
+    """Replays the events of one server log in order, writing sessions and matches"""
+
+    def __init__(self, db: sqlite3.Connection, file_id: int) -> None:
+        self.db = db
+        self.file_id = file_id
+        self.state = GameState.Lobby.name
+        self.map: Optional[str] = None
+        self.sessions: Dict[str, Dict[str, Any]] = {} # open sessions by player id
+
+    def feed(self, name: str, values: Tuple[str, ...]) -> None:
+        if name == 'connect':
+            player, ip = values[0], values[1]
+            if player not in self.sessions:
+                self.sessions[player] = {'player': player, 'ip': ip, 'name': None, 'level': None, 'elo': None,
+                                         'side': 0, 'deck': None, 'map': self.map, 'connect_state': self.state}
+        elif name in ('deck', 'level', 'elo', 'side', 'name'):
+            session = self.sessions.get(values[0])
+            if session is not None:
+                session[name] = convert_value(name, values[1])
+        elif name == 'disconnect':
+            session = self.sessions.pop(values[0], None)
+            if session is not None:
+                self.close(session, self.state)
+        elif name == 'map':
+            self.map = values[0]
+        elif name == 'game':
+            self.state = GameState.Game.name
+            self.start_match()
+        elif name == 'deployment':
+            self.state = GameState.Deployment.name
+        elif name == 'debriefing':
+            self.state = GameState.Debriefing.name
+        elif name == 'lobby':
+            self.state = GameState.Lobby.name
+
+    def start_match(self) -> None:
+        cursor = self.db.execute('INSERT INTO matches (file_id, map, num_players) VALUES (?, ?, ?)',
+                                 (self.file_id, self.map, len(self.sessions)))
+        self.db.executemany('INSERT INTO match_players (match_id, player, side, level) VALUES (?, ?, ?, ?)',
+                            [(cursor.lastrowid, s['player'], s['side'], s['level']) for s in self.sessions.values()])
+
+    def close(self, session: Dict[str, Any], disconnect_state: Optional[str]) -> None:
+        self.db.execute('INSERT INTO sessions (file_id, player, name, ip, level, elo, side, deck, map, connect_state, disconnect_state) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (self.file_id, session['player'], session['name'], session['ip'], session['level'], session['elo'],
+                         session['side'], session['deck'], session['map'], session['connect_state'], disconnect_state))
+
+    def finish(self) -> None:
+        for session in self.sessions.values():
+            self.close(session, None)
+        self.sessions = {}
+
+def convert_value(name: str, value: str) -> Any:
+    try:
+        if name in ('level', 'side'):
+            return int(value)
+        if name == 'elo':
+            return float(value)
+    except ValueError:
+        return None
+    if name == 'name':
+        return value.replace('"', '')
+    return value
+
+#================================================================================#
+# indexing
+#================================================================================#
+
+def open_db(path: str) -> sqlite3.Connection:
+    db = sqlite3.connect(path)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')
+    db.executescript(SCHEMA)
+    return db
+
+def register_file(db: sqlite3.Connection, kind: str, path: str) -> Optional[int]:
+    """Returns the file id to index into, or None if the file is already indexed and unchanged"""
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+    row = db.execute('SELECT id, size, mtime FROM files WHERE path = ?', (path,)).fetchone()
+    if row:
+        file_id, size, mtime = row
+        if size == stat.st_size and mtime == stat.st_mtime:
+            return None
+        # the file grew or was replaced: drop what we had and index it again
+        db.execute('DELETE FROM match_players WHERE match_id IN (SELECT id FROM matches WHERE file_id = ?)', (file_id,))
+        for table in ('matches', 'sessions', 'chat'):
+            db.execute(f'DELETE FROM {table} WHERE file_id = ?', (file_id,))
+        db.execute('UPDATE files SET size = ?, mtime = ?, indexed_at = ? WHERE id = ?', (stat.st_size, stat.st_mtime, time.time(), file_id))
+        return int(file_id)
+    cursor = db.execute('INSERT INTO files (path, kind, size, mtime, indexed_at) VALUES (?, ?, ?, ?, ?)',
+                        (path, kind, stat.st_size, stat.st_mtime, time.time()))
+    assert cursor.lastrowid is not None
+    return cursor.lastrowid
+
+def index_files(db: sqlite3.Connection, server_logs: List[str], chat_logs: List[str], jobs: int) -> None:
+    files: List[Tuple[str, str, int]] = []
+    for kind, paths in ((SERVER_LOG, server_logs), (CHAT_LOG, chat_logs)):
+        for path in paths:
+            file_id = register_file(db, kind, path)
+            if file_id is None:
+                print(f'unchanged, skipping: {path}')
+            else:
+                files.append((kind, path, file_id))
+
+    chunks: List[Chunk] = []
+    for kind, path, _ in files:
+        chunks += split_file(kind, path)
+    if not chunks:
+        db.commit()
+        return
+
+    # chunks come back in submission order, so each file's events can be
+    # replayed in order while later chunks are still being scanned
+    chunk_files = {(kind, path): file_id for kind, path, file_id in files}
+    builders: Dict[int, SessionBuilder] = {}
+    num_events = 0
+    started = time.time()
+    with multiprocessing.Pool(jobs) as pool:
+        for chunk, events in zip(chunks, pool.imap(scan_chunk, chunks)):
+            kind, path, start, end = chunk
+            file_id = chunk_files[(kind, path)]
+            num_events += len(events)
+            if kind == CHAT_LOG:
+                db.executemany('INSERT INTO chat (file_id, player, message) VALUES (?, ?, ?)',
+                               [(file_id, values[0], values[1]) for _, values in events])
+            else:
+                if file_id not in builders:
+                    builders[file_id] = SessionBuilder(db, file_id)
+                builder = builders[file_id]
+                for name, values in events:
+                    builder.feed(name, values)
+                if end == os.path.getsize(path):
+                    builder.finish()
+    db.commit()
+    print(f'indexed {len(files)} files, {num_events} events in {time.time() - started:.1f}s')
+
+#================================================================================#
+# queries
+#================================================================================#
+
+QUERIES: Dict[str, Tuple[str, str]] = {
+    'leavers': ('players who disconnect mid-game most', '''
+        SELECT player, MAX(name), COUNT(*) AS leaves
+        FROM sessions WHERE disconnect_state IN (?, ?)
+        GROUP BY player ORDER BY leaves DESC LIMIT ?'''),
+    'map-levels': ('average player level per map', '''
+        SELECT m.map, COUNT(DISTINCT m.id) AS games, ROUND(AVG(mp.level), 2) AS avg_level
+        FROM matches m JOIN match_players mp ON mp.match_id = m.id
+        GROUP BY m.map ORDER BY games DESC LIMIT ?'''),
+    'chatty': ('players who chat most', '''
+        SELECT c.player, (SELECT MAX(name) FROM sessions s WHERE s.player = c.player), COUNT(*) AS messages
+        FROM chat c GROUP BY c.player ORDER BY messages DESC LIMIT ?'''),
+}
+
+def query(db: sqlite3.Connection, name: str, args: List[str], limit: int) -> Iterator[Tuple[Any, ...]]:
+    if name == 'leavers':
+        return db.execute(QUERIES[name][1], IN_GAME_STATES + (limit,))
+    if name == 'player':
+        if not args:
+            raise ValueError('usage: player <EugNetId>')
+        return db.execute('''
+            SELECT player, GROUP_CONCAT(DISTINCT name), COUNT(*) AS sessions, ROUND(AVG(level), 2) AS avg_level,
+                   SUM(CASE WHEN disconnect_state IN (?, ?) THEN 1 ELSE 0 END) AS mid_game_leaves,
+                   (SELECT COUNT(*) FROM chat WHERE player = ?) AS messages
+            FROM sessions WHERE player = ? GROUP BY player''', IN_GAME_STATES + (args[0], args[0]))
+    return db.execute(QUERIES[name][1], (limit,))
+
+def main() -> None:
+    db_parser = argparse.ArgumentParser(add_help=False)
+    db_parser.add_argument("--db", help="path to the index database", default="logindex.sqlite")
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+    index_parser = subparsers.add_parser("index", parents=[db_parser], help="index server log archives")
+    index_parser.add_argument("server_logs", nargs="*", help="serverlog.txt archives")
+    index_parser.add_argument("--chat", nargs="*", default=[], help="chat.txt archives")
+    index_parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="number of scanning processes")
+    query_parser = subparsers.add_parser("query", parents=[db_parser], help="query the index: " + ', '.join(list(QUERIES.keys()) + ['player <id>']))
+    query_parser.add_argument("name", choices=list(QUERIES.keys()) + ['player'])
+    query_parser.add_argument("args", nargs="*")
+    query_parser.add_argument("--limit", type=int, default=20)
+    args = parser.parse_args()
+    if args.command is None:
+        parser.print_help()
+        return
+
+    db = open_db(args.db)
+    if args.command == "index":
+        index_files(db, args.server_logs, args.chat, args.jobs)
+    elif args.command == "query":
+        if args.name in QUERIES:
+            print(f'# {QUERIES[args.name][0]}')
+        try:
+            for row in query(db, args.name, args.args, args.limit):
+                print('\t'.join('' if v is None else str(v) for v in row))
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
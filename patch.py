@@ -1,10 +1,15 @@
 #!/usr/bin/env python3
 
-from shutil import copyfile
+from concurrent.futures import ThreadPoolExecutor
 import binascii
+import json
+import mmap
+import os
+import shutil
 import sys
 import argparse
 import hashlib
+from typing import Any, Dict, List, Optional, Tuple
 
 EXPECTED_SHA_HASH = '045488f037e346dca3404737dcc6951f146a2a37ba233dd307b5fead0429c151'
 
@@ -13,7 +18,7 @@ PATCHED_JZ_CALL_BYTES = '9090909090909090909090908b450c8904249090909090e8bc72060
 NEW_COMMAND_NAME = '6368617400' # 'chat\0'
 PATCHED_VERSION_CHECK = 'b804000000c3'
 
-def hash_file(filename):
+def hash_file(filename: str) -> str:
     h = hashlib.sha256()
     b = bytearray(128*1024)
     mv = memoryview(b)
@@ -25,7 +30,7 @@ def hash_file(filename):
 ELF_BASE = 0x08048000
 
 AVAILBLE_BYTES = (0x080c0c6f - 0x080c0580)
-assert len(NEW_FUNCTION_BYTES) < AVAILBLE_BYTES, 'overwriting! ' + str(len(NEW_FUNCTION_BYTES)) + ' >= ' + str(AVAILBLE_BYTES) 
+assert len(NEW_FUNCTION_BYTES) < AVAILBLE_BYTES, 'overwriting! ' + str(len(NEW_FUNCTION_BYTES)) + ' >= ' + str(AVAILBLE_BYTES)
 
 ADD_RCON_WRITE_COMMAND = [
     (0x080592a8, PATCHED_JZ_CALL_BYTES),
@@ -39,25 +44,178 @@ SKIP_GAME_VERSION_CHECK = [
 
 offsets = ADD_RCON_WRITE_COMMAND + SKIP_GAME_VERSION_CHECK
 
-def patch_file(input):
-    output = input + '.patched'
-    copyfile(input, output)
+# The patches above as a manifest. A manifest describes one exact input binary:
+#   {
+#     "sha256": "<hash of the unpatched binary>",
+#     "patched_sha256": "<hash of the result, optional, needed for --reverse>",
+#     "size": <input size in bytes, optional, used to pick between manifests>,
+#     "elf_base": "0x08048000",
+#     "patches": [ { "vaddr": "0x080592a8", "original": "<hex, optional>", "new": "<hex>" }, ... ]
+#   }
+# Patches with "original" bytes are verified before being applied, and can be
+# reversed. --write-manifest fills those in from a matching binary.
+DEFAULT_MANIFEST: Dict[str, Any] = {
+    'sha256': EXPECTED_SHA_HASH,
+    'elf_base': hex(ELF_BASE),
+    'patches': [{'vaddr': hex(vaddr), 'new': patch} for (vaddr, patch) in offsets],
+}
+
+CHUNK_SIZE = 4 * 1024 * 1024
+
+class PatchError(Exception):
+    pass
+
+# (file offset, expected bytes or None, replacement bytes)
+Patch = Tuple[int, Optional[bytes], bytes]
+
+def load_manifest(path: str) -> Dict[str, Any]:
+    with open(path) as fin:
+        manifest = json.load(fin)
+    if not isinstance(manifest, dict) or 'sha256' not in manifest or not isinstance(manifest.get('patches'), list):
+        raise PatchError(path + ': not a patch manifest, expected an object with "sha256" and a "patches" list')
+    return manifest
+
+def manifest_patches(manifest: Dict[str, Any], reverse: bool) -> List[Patch]:
+    """Turn manifest entries into sorted, non-overlapping file offsets"""
+    elf_base = int(str(manifest.get('elf_base', hex(ELF_BASE))), 16)
+    patches: List[Patch] = []
+    for entry in manifest['patches']:
+        pos = int(str(entry['vaddr']), 16) - elf_base
+        original = binascii.unhexlify(entry['original']) if entry.get('original') else None
+        new = binascii.unhexlify(entry['new'])
+        if original is not None and len(original) != len(new):
+            raise PatchError('patch at ' + str(entry['vaddr']) + ': original and new bytes differ in length')
+        if reverse:
+            if original is None:
+                raise PatchError('cannot reverse patch at ' + str(entry['vaddr']) + ': manifest has no original bytes (see --write-manifest)')
+            original, new = new, original
+        patches.append((pos, original, new))
+    patches.sort()
+    for (pos, _, new), (next_pos, _, _) in zip(patches, patches[1:]):
+        if pos + len(new) > next_pos:
+            raise PatchError('overlapping patches at 0x%08x and 0x%08x' % (pos, next_pos))
+    return patches
+
+def select_manifest(input: str, manifests: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Pick the manifest for this binary by size, without reading it; fall back to hashing if that's ambiguous"""
+    if len(manifests) == 1:
+        return manifests[0]
+    size = os.path.getsize(input)
+    candidates = [m for m in manifests if m.get('size') in (None, size)]
+    if len(candidates) == 1:
+        return candidates[0]
     input_hash = hash_file(input)
-    if input_hash != EXPECTED_SHA_HASH:
-        print('input binary must be an exact match, but has SHA256: ' + input_hash + ' (expected: ' + EXPECTED_SHA_HASH + ')')
-        sys.exit(1)
-    with open(output, 'r+b') as f:
-        for (offset, patch) in offsets:
-            raw_patch = binascii.unhexlify(patch)
-            pos = offset - ELF_BASE
-            f.seek(pos)
-            f.write(raw_patch)
-            print('wrote ' + str(len(raw_patch)) + ' bytes at 0x%08x' % pos)
-    print('patched binary written to: ' + output)
-    print('patched binary hash (SHA256): ' + hash_file(output))
+    for m in candidates:
+        if input_hash in (m['sha256'], m.get('patched_sha256')):
+            return m
+    raise PatchError(input + ': no manifest for SHA256 ' + input_hash)
+
+def patch_file(input: str, manifest: Dict[str, Any]=DEFAULT_MANIFEST, reverse: bool=False,
+               dry_run: bool=False, fill_originals: bool=False) -> Tuple[str, List[Dict[str, Any]]]:
+    """
+    Verify and patch `input` in a single pass: the input is mmapped and walked
+    once, hashing it, checking each patch's original bytes and hashing the
+    patched result as the output is written. Nothing is left behind if any
+    check fails. Returns the output hash and the manifest entries with the
+    original bytes seen in the input.
+    """
+    expected_hash = manifest.get('patched_sha256') if reverse else manifest['sha256']
+    if reverse and not expected_hash:
+        raise PatchError('cannot reverse: manifest has no patched_sha256')
+    patches = manifest_patches(manifest, reverse)
+    output = input + ('.unpatched' if reverse else '.patched')
+    input_hash, output_hash = hashlib.sha256(), hashlib.sha256()
+    seen: List[bytes] = []
+
+    with open(input, 'rb') as fin, mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        size = len(mm)
+        if patches and patches[-1][0] + len(patches[-1][2]) > size:
+            raise PatchError(input + ': patch beyond the end of the file')
+        # the patched ranges are tiny, so check them before writing anything
+        for pos, original, new in patches:
+            current = mm[pos:pos + len(new)]
+            seen.append(current)
+            if original is not None and current != original and not fill_originals:
+                raise PatchError(input + ': unexpected bytes at 0x%08x: %s (expected %s)' % (pos, current.hex(), original.hex()))
+
+        fout = None if dry_run else open(output, 'wb')
+        try:
+            first = 0 # first patch that doesn't end before the current chunk
+            for start in range(0, size, CHUNK_SIZE):
+                end = min(start + CHUNK_SIZE, size)
+                chunk = mm[start:end]
+                input_hash.update(chunk)
+                while first < len(patches) and patches[first][0] + len(patches[first][2]) <= start:
+                    first += 1
+                i = first
+                if i < len(patches) and patches[i][0] < end:
+                    buf = bytearray(chunk)
+                    # a patch may straddle two chunks, so copy only the overlapping part
+                    while i < len(patches) and patches[i][0] < end:
+                        pos, _, new = patches[i]
+                        lo, hi = max(pos, start), min(pos + len(new), end)
+                        buf[lo - start:hi - start] = new[lo - pos:hi - pos]
+                        i += 1
+                    chunk = bytes(buf)
+                output_hash.update(chunk)
+                if fout:
+                    fout.write(chunk)
+            if input_hash.hexdigest() != expected_hash:
+                raise PatchError(input + ': input binary must be an exact match, but has SHA256: ' + input_hash.hexdigest() + ' (expected: ' + str(expected_hash) + ')')
+        except BaseException:
+            if fout:
+                fout.close()
+                os.remove(output)
+            raise
+        if fout:
+            fout.close()
+            shutil.copymode(input, output)
+
+    elf_base = int(str(manifest.get('elf_base', hex(ELF_BASE))), 16)
+    entries = []
+    for (pos, _, new), original in zip(patches, seen):
+        entries.append({'vaddr': '0x%08x' % (pos + elf_base), 'original': original.hex(), 'new': new.hex()})
+        print(('would write ' if dry_run else 'wrote ') + str(len(new)) + ' bytes at 0x%08x' % pos)
+    if not dry_run:
+        print('patched binary written to: ' + output)
+    print('patched binary hash (SHA256): ' + output_hash.hexdigest())
+    return output_hash.hexdigest(), entries
+
+def write_manifest(input: str, manifest: Dict[str, Any], path: str) -> None:
+    """Record the original bytes and the patched hash, so the patch can be verified and reversed"""
+    output_hash, entries = patch_file(input, manifest, dry_run=True, fill_originals=True)
+    full = dict(manifest, size=os.path.getsize(input), patched_sha256=output_hash, patches=entries)
+    with open(path, 'w') as fout:
+        json.dump(full, fout, indent=2)
+    print('manifest written to: ' + path)
+
+def patch_files(inputs: List[str], manifests: List[Dict[str, Any]], reverse: bool, dry_run: bool, jobs: int) -> bool:
+    """Patch many binaries concurrently (hashing and file io release the GIL). Returns whether all succeeded"""
+    def run(input: str) -> bool:
+        try:
+            patch_file(input, select_manifest(input, manifests), reverse=reverse, dry_run=dry_run)
+            return True
+        except (PatchError, OSError) as e:
+            print(str(e))
+            return False
+    with ThreadPoolExecutor(max(1, jobs)) as pool:
+        return all(list(pool.map(run, inputs)))
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("input", help="path to wargame server input")
+    parser.add_argument("input", nargs="+", help="path to wargame server input(s)")
+    parser.add_argument("--manifest", action="append", default=[], help="patch manifest (json), may be given several times; defaults to the built-in patches")
+    parser.add_argument("--reverse", action="store_true", help="restore the original bytes of a patched binary")
+    parser.add_argument("--dry-run", action="store_true", help="verify only, don't write an output file")
+    parser.add_argument("--write-manifest", help="write a complete manifest (with original bytes) for the input to this path")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="binaries to patch at once")
     args = parser.parse_args()
-    patch_file(args.input)
+    try:
+        manifests = [load_manifest(path) for path in args.manifest] or [DEFAULT_MANIFEST]
+        if args.write_manifest:
+            write_manifest(args.input[0], select_manifest(args.input[0], manifests), args.write_manifest)
+        elif not patch_files(args.input, manifests, args.reverse, args.dry_run, args.jobs):
+            sys.exit(1)
+    except PatchError as e:
+        print(str(e))
+        sys.exit(1)